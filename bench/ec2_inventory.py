@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+'''
+EC2 inventory benchmark
+=======================
+
+Measures inventory/aws/hosts/ec2.py offline. The script is driven in process
+against a fake of boto.ec2, boto.rds and boto.route53 that serves synthetic
+reservations, tags and Route53 record sets, optionally sleeping on every API
+call to stand in for network latency.
+
+Each scenario runs in its own Python process, so that its peak RSS is its own,
+and goes through three phases:
+
+ - refresh: ec2.py --refresh-cache --list (API calls, cache writes)
+ - list:    ec2.py --list served from the cache
+ - host:    ec2.py --host for one host, served from the cache
+
+For every phase the wall time, the number of API calls and the size of the
+output are reported, along with the peak RSS of the scenario.
+
+Scenarios are the cross product of the comma separated values given to
+--instances, --regions, --tags and --zones:
+
+    python bench/ec2_inventory.py --instances 100,1000,5000 --regions 1,10 \\
+        --latency 0.05
+
+The settings come from inventory/aws/hosts/ec2.ini, or from --ini, with the
+regions and cache_path replaced; --set overrides any other option:
+
+    python bench/ec2_inventory.py --set route53=False --set cache_backend=json
+
+--json prints one JSON document per scenario instead of the table.
+'''
+
+import sys
+import os
+import argparse
+import ConfigParser
+import imp
+import itertools
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+EC2_PY = os.path.join(ROOT, 'inventory', 'aws', 'hosts', 'ec2.py')
+EC2_INI = os.path.join(ROOT, 'inventory', 'aws', 'hosts', 'ec2.ini')
+
+# Environment read by ec2.py that would narrow the scenario down
+SCOPE_ENVIRONMENT = ['EC2_INVENTORY_REGION', 'EC2_INVENTORY_CLUSTER_ID',
+                     'EC2_INVENTORY_ROUTE53_ZONE']
+
+
+class FakeAWS(object):
+    ''' The synthetic account served by the fake boto modules. Every API call
+    is counted and delayed by the configured latency. '''
+
+    def __init__(self, scenario):
+        self.instances = scenario['instances']
+        self.regions = ['bench-%d' % i for i in range(scenario['regions'])]
+        self.tags = scenario['tags']
+        self.tag_values = scenario['tag_values']
+        self.clusters = scenario['clusters']
+        self.zones = scenario['zones']
+        self.rrsets = scenario['rrsets']
+        self.latency = scenario['latency']
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def region_instances(self, region):
+        ''' Instances of a region; the count is spread evenly over regions '''
+
+        index = self.regions.index(region)
+        count = self.instances // len(self.regions)
+        if index < self.instances % len(self.regions):
+            count += 1
+        return [FakeInstance(self, region, index, i) for i in range(count)]
+
+    def ip_address(self, region_index, i):
+        return '54.%d.%d.%d' % (region_index, i // 250 % 250, i % 250)
+
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeResultSet(list):
+    next_token = None
+
+
+class FakeInstance(object):
+    ''' Carries the attributes of boto.ec2.instance.Instance that ec2.py turns
+    into host variables '''
+
+    def __init__(self, aws, region, region_index, i):
+        cluster = 'cluster-%d' % (i % aws.clusters)
+        self.id = 'i-%02x%06x' % (region_index, i)
+        self.groups = [FakeObject(id='sg-%04x' % (i % 7), name='group-%d' % (i % 7)),
+                       FakeObject(id='sg-ffff', name='default')]
+        self.tags = {
+            'Name': '%s-host-%d' % (cluster, i),
+            'openshift-demo': cluster,
+            'openshift-demo-%s-host-type' % cluster: ('master', 'infra', 'node', 'node')[i % 4],
+        }
+        for tag in range(aws.tags):
+            self.tags['bench-tag-%d' % tag] = 'value-%d' % (i % aws.tag_values)
+        self.public_dns_name = 'ec2-%s-%d.%s.compute.amazonaws.com' % (
+            aws.ip_address(region_index, i).replace('.', '-'), i, region)
+        self.private_dns_name = 'ip-10-%d-%d-%d.ec2.internal' % (region_index, i // 250 % 250, i % 250)
+        self._state = 'running'
+        self.state_code = 16
+        self._previous_state = None
+        self.previous_state_code = 0
+        self.key_name = 'demo'
+        self.instance_type = ('m4.large', 'm4.xlarge', 'c4.2xlarge')[i % 3]
+        self.launch_time = '2015-06-01T00:00:00.000Z'
+        self.image_id = 'ami-%08x' % (i % 3)
+        self._placement = FakeObject(zone='%s%s' % (region, 'abc'[i % 3]))
+        self.kernel = None
+        self.ramdisk = None
+        self.architecture = 'x86_64'
+        self.hypervisor = 'xen'
+        self.virtualization_type = 'hvm'
+        self.monitored = False
+        self.monitoring_state = 'disabled'
+        self.spot_instance_request_id = None
+        self.subnet_id = 'subnet-%04x' % (i % 3)
+        self.vpc_id = 'vpc-0001'
+        self.private_ip_address = '10.%d.%d.%d' % (region_index, i // 250 % 250, i % 250)
+        self.ip_address = aws.ip_address(region_index, i)
+        self.platform = None
+        self.root_device_name = '/dev/xvda'
+        self.root_device_type = 'ebs'
+        self.block_device_mapping = {'/dev/xvda': FakeObject(volume_id='vol-%08x' % i)}
+        self.region = FakeObject(name=region)
+        self.ami_launch_index = u'0'
+        self.ebs_optimized = False
+        self.instance_profile = None
+        self.interfaces = []
+        self.sourceDestCheck = u'true'
+        self.client_token = ''
+        self.group_name = None
+        self.persistent = False
+        self.product_codes = []
+        self.requester_id = None
+        self.reason = ''
+
+    state = property(lambda self: self._state)
+    previous_state = property(lambda self: self._previous_state)
+    placement = property(lambda self: self._placement.zone)
+
+
+class FakeEC2Connection(object):
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             max_results=None, next_token=None, **kwargs):
+        self.aws.call()
+        instances = [instance for instance in self.aws.region_instances(self.region)
+                     if self.matches(instance, instance_ids, filters)]
+        start = int(next_token or 0)
+        end = start + max_results if max_results else len(instances)
+        reservations = FakeResultSet(FakeObject(instances=[instance])
+                                     for instance in instances[start:end])
+        if end < len(instances):
+            reservations.next_token = str(end)
+        return reservations
+
+    get_all_instances = get_all_reservations
+
+    def get_all_instance_status(self, max_results=None, next_token=None, **kwargs):
+        self.aws.call()
+        instances = self.aws.region_instances(self.region)
+        start = int(next_token or 0)
+        end = start + (max_results or 1000)
+        statuses = FakeResultSet(FakeObject(id=instance.id, state_name=instance.state)
+                                 for instance in instances[start:end])
+        if end < len(instances):
+            statuses.next_token = str(end)
+        return statuses
+
+    def matches(self, instance, instance_ids, filters):
+        if instance_ids is not None and instance.id not in instance_ids:
+            return False
+        for name, values in (filters or {}).iteritems():
+            if not isinstance(values, list):
+                values = [values]
+            if name == 'instance-state-name':
+                value = instance.state
+            elif name == 'tag-key':
+                if not [key for key in values if key in instance.tags]:
+                    return False
+                continue
+            elif name.startswith('tag:'):
+                value = instance.tags.get(name[4:])
+            else:
+                value = getattr(instance, name.replace('-', '_'), None)
+            if value not in values:
+                return False
+        return True
+
+
+class FakeRDSConnection(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_all_dbinstances(self):
+        self.aws.call()
+        return []
+
+
+class FakeRoute53Connection(object):
+    ''' Each zone holds rrsets records; they point at the public addresses of
+    the instances in turn '''
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_zones(self):
+        self.aws.call()
+        return [FakeObject(id='Z%06d' % zone, name='zone-%d.example.com.' % zone,
+                           resourcerecordsetcount=str(self.aws.rrsets))
+                for zone in range(self.aws.zones)]
+
+    def get_all_rrsets(self, zone_id):
+        self.aws.call()
+        zone = int(zone_id[1:])
+        per_region = max(self.aws.instances // len(self.aws.regions), 1)
+        rrsets = []
+        for record in range(self.aws.rrsets):
+            i = zone * self.aws.rrsets + record
+            address = self.aws.ip_address(i // per_region % len(self.aws.regions), i % per_region)
+            rrsets.append(FakeObject(name='host-%d.zone-%d.example.com.' % (record, zone),
+                                     resource_records=[address]))
+        return rrsets
+
+
+def install_fake_boto(aws):
+    ''' Puts fake boto, boto.ec2, boto.rds, boto.route53 and boto.exception
+    modules in sys.modules, ahead of any installed boto '''
+
+    class BotoServerError(Exception):
+        def __init__(self, status, reason, body=None):
+            Exception.__init__(self, status, reason)
+            self.status = status
+            self.reason = reason
+            self.body = body
+
+    modules = {}
+    for name in ['boto', 'boto.ec2', 'boto.rds', 'boto.route53', 'boto.exception']:
+        modules[name] = sys.modules[name] = types.ModuleType(name)
+
+    boto = modules['boto']
+    boto.ec2 = modules['boto.ec2']
+    boto.rds = modules['boto.rds']
+    boto.route53 = modules['boto.route53']
+    boto.exception = modules['boto.exception']
+
+    def connect_euca(host=None, **kwargs):
+        raise NotImplementedError('the benchmark does not fake Eucalyptus')
+
+    boto.connect_euca = connect_euca
+    boto.exception.BotoServerError = BotoServerError
+    boto.ec2.regions = lambda: [FakeObject(name=region) for region in aws.regions]
+    boto.ec2.connect_to_region = lambda region, **kwargs: FakeEC2Connection(aws, region)
+    boto.rds.connect_to_region = lambda region, **kwargs: FakeRDSConnection(aws)
+    boto.route53.Route53Connection = lambda *args, **kwargs: FakeRoute53Connection(aws)
+
+
+class CountingWriter(object):
+    ''' Stands in for sys.stdout, keeping only the number of bytes written '''
+
+    def __init__(self):
+        self.size = 0
+        self.data = []
+        self.keep = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.keep:
+            self.data.append(data)
+
+    def flush(self):
+        pass
+
+
+def write_settings(scenario, cache_path, filename):
+    ''' Writes the ec2.ini of a scenario '''
+
+    config = ConfigParser.RawConfigParser()
+    config.read(scenario['ini'])
+    config.set('ec2', 'regions', ','.join('bench-%d' % i for i in range(scenario['regions'])))
+    config.set('ec2', 'cache_path', cache_path)
+    for option in scenario['set']:
+        name, value = option.split('=', 1)
+        config.set('ec2', name.strip(), value.strip())
+    with open(filename, 'w') as ini_file:
+        config.write(ini_file)
+
+
+def run_scenario(scenario):
+    ''' Runs the phases of a scenario in this process and returns its
+    measurements '''
+
+    aws = FakeAWS(scenario)
+    install_fake_boto(aws)
+
+    for name in SCOPE_ENVIRONMENT:
+        os.environ.pop(name, None)
+
+    workdir = tempfile.mkdtemp(prefix='ec2-bench-')
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        write_settings(scenario, os.path.join(workdir, 'cache'), ini_path)
+        os.environ['EC2_INI_PATH'] = ini_path
+
+        # Loading the script runs nothing but its imports
+        script = imp.load_source('ec2_inventory_script', EC2_PY)
+
+        phases = []
+        host = None
+        for name, args in [('refresh', ['--refresh-cache', '--list']),
+                           ('list', ['--list']),
+                           ('host', ['--host'])]:
+            if name == 'host':
+                if host is None:
+                    continue
+                args = args + [host]
+
+            calls = aws.calls
+            output = CountingWriter()
+            output.keep = (name == 'list')
+            sys.argv = [EC2_PY] + args
+            sys.stdout = output
+            start = time.time()
+            try:
+                script.Ec2Inventory()
+            finally:
+                sys.stdout = sys.__stdout__
+            phases.append({'phase': name,
+                           'seconds': time.time() - start,
+                           'api_calls': aws.calls - calls,
+                           'output_bytes': output.size})
+
+            if name == 'list':
+                hostvars = json.loads(''.join(output.data))['_meta']['hostvars']
+                if hostvars:
+                    host = sorted(hostvars)[0]
+                hosts = len(hostvars)
+
+        return {'scenario': scenario,
+                'hosts': hosts,
+                'phases': phases,
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def spawn_scenario(scenario):
+    ''' Runs a scenario in a fresh Python process and returns its
+    measurements '''
+
+    process = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                                '--scenario', json.dumps(scenario)],
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        sys.stderr.write('scenario %s failed with exit code %d\n' % (
+            json.dumps(scenario, sort_keys=True), process.returncode))
+        return None
+    return json.loads(output)
+
+
+def print_table(results):
+    header = ('instances', 'regions', 'tags', 'zones', 'hosts', 'phase',
+              'seconds', 'API calls', 'output KB', 'peak RSS MB')
+    rows = []
+    for result in results:
+        scenario = result['scenario']
+        for phase in result['phases']:
+            rows.append((scenario['instances'], scenario['regions'], scenario['tags'],
+                         scenario['zones'], result['hosts'], phase['phase'],
+                         '%.3f' % phase['seconds'], phase['api_calls'],
+                         '%.1f' % (phase['output_bytes'] / 1024.0),
+                         '%.1f' % (result['peak_rss_kb'] / 1024.0)))
+
+    widths = [max(len(str(row[column])) for row in rows + [header])
+              for column in range(len(header))]
+    for row in [header] + rows:
+        print '  '.join(str(value).rjust(width) for value, width in zip(row, widths))
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the EC2 inventory against a fake AWS account')
+    parser.add_argument('--instances', type=parse_counts, default=[100, 1000],
+                        help='Instance counts, spread over the regions (default: 100,1000)')
+    parser.add_argument('--regions', type=parse_counts, default=[1, 4],
+                        help='Region counts (default: 1,4)')
+    parser.add_argument('--tags', type=parse_counts, default=[3],
+                        help='Extra tags per instance (default: 3)')
+    parser.add_argument('--tag-values', type=int, default=10,
+                        help='Distinct values of each extra tag (default: 10)')
+    parser.add_argument('--clusters', type=int, default=3,
+                        help='Demo clusters the instances are tagged with (default: 3)')
+    parser.add_argument('--zones', type=parse_counts, default=[3],
+                        help='Route53 hosted zone counts (default: 3)')
+    parser.add_argument('--rrsets', type=int, default=50,
+                        help='Record sets per hosted zone (default: 50)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each API call takes (default: 0)')
+    parser.add_argument('--ini', default=EC2_INI,
+                        help='ec2.ini to start from (default: the inventory one)')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Override an ec2.ini option, may be repeated')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Print one JSON document per scenario')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print json.dumps(run_scenario(json.loads(args.scenario)))
+        return 0
+
+    results = []
+    for instances, regions, tags, zones in itertools.product(args.instances, args.regions,
+                                                             args.tags, args.zones):
+        result = spawn_scenario({'instances': instances, 'regions': regions, 'tags': tags,
+                                 'tag_values': args.tag_values, 'clusters': args.clusters,
+                                 'zones': zones, 'rrsets': args.rrsets,
+                                 'latency': args.latency, 'ini': args.ini, 'set': args.set})
+        if result is None:
+            return 1
+        if args.json:
+            print json.dumps(result)
+            sys.stdout.flush()
+        results.append(result)
+
+    if not args.json:
+        print_table(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+'''
+Subscription pool parser benchmark
+==================================
+
+Measures how playbooks/library/redhat_subscription.py parses the output of
+subscription-manager list --available, which lists thousands of pools for
+some accounts. The module is loaded with a stand-in for
+ansible.module_utils.basic, and subscription-manager is replaced by a
+captured or a synthetic listing.
+
+Each run parses a listing in its own Python process, so that its peak RSS is
+its own, in one of three ways:
+
+ - all:  every pool is kept, as for subscription-manager list --consumed
+ - name: pools are kept when their name matches --regexp, as the playbooks do
+ - ids:  pools are kept when their ID is one of --ids pool IDs of the listing
+
+For every run the wall time, the number of pools kept and how much the peak
+RSS grew while parsing are reported.
+
+Synthetic listings have --pools pools, the given share of them (--match)
+named after the subscriptions the playbooks look for, each providing
+--provides products:
+
+    python bench/rhsm_pools.py --pools 1000,10000,50000 --match 0.01
+
+Captured listings are timed instead with --listing, once per file:
+
+    subscription-manager list --available > available.txt
+    python bench/rhsm_pools.py --listing available.txt
+
+--json prints one JSON document per run instead of the table.
+'''
+
+import sys
+import os
+import argparse
+import imp
+import itertools
+import re
+import resource
+import subprocess
+import time
+import types
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+MODULE = os.path.join(ROOT, 'playbooks', 'library', 'redhat_subscription.py')
+
+# The pools register_hosts.yml subscribes to
+REGEXP = '^(60 Day Supported OpenShift Enterprise|OpenShift Enterprise, Standard|OpenShift Enterprise, Premium|Employee)'
+
+MODES = ['all', 'name', 'ids']
+
+
+class FakeModule(object):
+    ''' Stands in for AnsibleModule, answering subscription-manager list with
+    the listing of the run '''
+
+    def __init__(self, listing):
+        self.listing = listing
+
+    def run_command(self, args, check_rc=False):
+        return 0, self.listing, ''
+
+
+def load_module():
+    ''' Loads the module, with an empty ansible.module_utils.basic to import
+    from, without running it '''
+
+    for name in ['ansible', 'ansible.module_utils', 'ansible.module_utils.basic']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    return imp.load_source('redhat_subscription', MODULE)
+
+
+def synthetic_listing(pools, match, provides):
+    ''' Returns a listing in the format of subscription-manager list
+    --available '''
+
+    lines = ['+-------------------------------------------+',
+             '    Available Subscriptions',
+             '+-------------------------------------------+']
+    every = int(1 / match) if match > 0 else 0
+    for i in range(pools):
+        if every and i % every == 0:
+            name = 'OpenShift Enterprise, Standard (%d)' % i
+        else:
+            name = 'Red Hat Product %d' % i
+        lines.append('Subscription Name: %s' % name)
+        lines.append('Provides:          Red Hat Product %d Component 0' % i)
+        for j in range(1, provides):
+            lines.append('                   Red Hat Product %d Component %d' % (i, j))
+        lines.extend(['SKU:               RH%08d' % i,
+                      'Contract:          %08d' % i,
+                      'Pool ID:           8a85f98144844aff%016x' % i,
+                      'Available:         10',
+                      'Suggested:         1',
+                      'Service Level:     Standard',
+                      'Service Type:      L1-L3',
+                      'Subscription Type: Standard',
+                      'Ends:              12/31/2020',
+                      'System Type:       Physical',
+                      ''])
+    return '\n'.join(lines) + '\n'
+
+
+def run_parse(run):
+    ''' Parses the listing of a run in this process and returns its
+    measurements '''
+
+    module = load_module()
+    if run['input']:
+        with open(run['input']) as listing_file:
+            listing = listing_file.read()
+    else:
+        listing = synthetic_listing(run['pools'], run['match'], run['provides'])
+
+    regexp = None
+    pool_ids = None
+    if run['mode'] == 'name':
+        regexp = run['regexp']
+    elif run['mode'] == 'ids':
+        # spread over the listing, as parsing stops at none of them; found
+        # without parsing so as not to raise the peak RSS beforehand
+        ids = re.findall(r'^Pool ?ID:\s*(\S+)', listing, re.MULTILINE)
+        step = max(len(ids) // max(run['ids'], 1), 1)
+        pool_ids = ids[::step][:run['ids']]
+        del ids
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    pools = module.RhsmPools(FakeModule(listing), regexp=regexp, pool_ids=pool_ids)
+    seconds = time.time() - start
+
+    return {'run': run,
+            'listing_bytes': len(listing),
+            'kept': len(pools.products),
+            'seconds': seconds,
+            'rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss}
+
+
+def spawn_parse(run):
+    ''' Parses in a fresh Python process and returns its measurements '''
+
+    process = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                                '--run', json.dumps(run)],
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        sys.stderr.write('run %s failed with exit code %d\n' % (
+            json.dumps(run, sort_keys=True), process.returncode))
+        return None
+    return json.loads(output)
+
+
+def print_table(results):
+    header = ('listing', 'pools', 'listing KB', 'mode', 'kept', 'seconds', 'RSS growth MB')
+    rows = []
+    for result in results:
+        run = result['run']
+        rows.append((os.path.basename(run['input']) if run['input'] else 'synthetic',
+                     run['pools'] if not run['input'] else '-',
+                     '%.1f' % (result['listing_bytes'] / 1024.0),
+                     run['mode'], result['kept'], '%.3f' % result['seconds'],
+                     '%.1f' % (result['rss_growth_kb'] / 1024.0)))
+
+    widths = [max(len(str(row[column])) for row in rows + [header])
+              for column in range(len(header))]
+    for row in [header] + rows:
+        print '  '.join(str(value).rjust(width) for value, width in zip(row, widths))
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the subscription pool parser of redhat_subscription')
+    parser.add_argument('--pools', type=parse_counts, default=[1000, 10000],
+                        help='Pools in the synthetic listings (default: 1000,10000)')
+    parser.add_argument('--match', type=float, default=0.01,
+                        help='Share of the synthetic pools matching --regexp (default: 0.01)')
+    parser.add_argument('--provides', type=int, default=10,
+                        help='Products provided by each synthetic pool (default: 10)')
+    parser.add_argument('--listing', '--input', dest='input', action='append', default=[], metavar='FILE',
+                        help='Captured subscription-manager list --available output, may be repeated')
+    parser.add_argument('--regexp', default=REGEXP,
+                        help='Pool name regexp of the name mode (default: the one of register_hosts.yml)')
+    parser.add_argument('--ids', type=int, default=3,
+                        help='Pool IDs looked for in the ids mode (default: 3)')
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        help='Ways of parsing to measure, may be repeated (default: all of them)')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Print one JSON document per run')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print json.dumps(run_parse(json.loads(args.run)))
+        return 0
+
+    listings = [(os.path.abspath(path), None) for path in args.input] or \
+               [(None, pools) for pools in args.pools]
+
+    results = []
+    for (path, pools), mode in itertools.product(listings, args.mode or MODES):
+        result = spawn_parse({'input': path, 'pools': pools, 'match': args.match,
+                              'provides': args.provides, 'regexp': args.regexp,
+                              'ids': args.ids, 'mode': mode})
+        if result is None:
+            return 1
+        if args.json:
+            print json.dumps(result)
+            sys.stdout.flush()
+        results.append(result)
+
+    if not args.json:
+        print_table(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
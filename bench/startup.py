@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+'''
+Startup benchmark
+=================
+
+Measures what it costs to start the scripts that are run over and over:
+
+ - ec2.py --list: Ansible runs the inventory script for every playbook, and
+   run.py for every stage, so a warm cache should be served without paying
+   for boto
+ - run.py --help: what any run.py invocation pays before it does anything
+
+The cache of ec2.py is warmed once against the fake AWS account of
+bench/ec2_inventory.py. Every command is then started --repeat times as a
+fresh process, exactly as Ansible starts it, and the fastest, median and
+slowest wall times are reported next to those of a bare interpreter. The
+modules a command imports are listed when they include one of --heavy:
+
+    python bench/startup.py --instances 1000 --repeat 20
+
+With --budget, the command exits with 1 if the median of ec2.py --list,
+less the interpreter start, takes more milliseconds than the budget:
+
+    python bench/startup.py --budget 50
+'''
+
+import sys
+import os
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import ec2_inventory
+
+
+ROOT = ec2_inventory.ROOT
+RUN_PY = os.path.join(ROOT, 'run.py')
+
+# Prints the top level modules a script imports, once it has run
+MODULES_PROBE = '''
+import os, sys, runpy
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(script))
+before = set(sys.modules)
+stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+try:
+    runpy.run_path(script, run_name='__main__')
+except SystemExit:
+    pass
+sys.stdout = stdout
+print ' '.join(sorted(set(name.split('.')[0] for name in sys.modules
+                          if sys.modules[name] is not None and name not in before)))
+'''
+
+
+def warm_cache(scenario, workdir):
+    ''' Refreshes the cache of ec2.py against the fake AWS account, in a
+    process of its own as the fake replaces boto, and returns the path of
+    the ec2.ini that uses it '''
+
+    ini_path = os.path.join(workdir, 'ec2.ini')
+    ec2_inventory.write_settings(scenario, os.path.join(workdir, 'cache'), ini_path)
+    process = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                                '--warm', json.dumps(scenario), ini_path])
+    if process.wait() != 0:
+        return None
+    return ini_path
+
+
+def run_warm(scenario, ini_path):
+    aws = ec2_inventory.FakeAWS(scenario)
+    ec2_inventory.install_fake_boto(aws)
+    for name in ec2_inventory.SCOPE_ENVIRONMENT:
+        os.environ.pop(name, None)
+    os.environ['EC2_INI_PATH'] = ini_path
+
+    import imp
+    script = imp.load_source('ec2_inventory_script', ec2_inventory.EC2_PY)
+    sys.argv = [ec2_inventory.EC2_PY, '--refresh-cache', '--list']
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        script.Ec2Inventory()
+    finally:
+        sys.stdout = sys.__stdout__
+
+
+def time_command(args, env, repeat):
+    ''' Starts a command repeat times and returns the sorted wall times, or
+    None if it failed '''
+
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            exit_code = subprocess.call(args, stdout=devnull, env=env, cwd=ROOT)
+            times.append(time.time() - start)
+            if exit_code != 0:
+                sys.stderr.write('%s failed with exit code %d\n' % (' '.join(args), exit_code))
+                return None
+    return sorted(times)
+
+
+def imported_modules(script, args, env):
+    output = subprocess.Popen([sys.executable, '-c', MODULES_PROBE, script] + args,
+                              stdout=subprocess.PIPE, env=env, cwd=ROOT).communicate()[0]
+    return output.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup of ec2.py and run.py')
+    parser.add_argument('--instances', type=int, default=1000,
+                        help='Instances in the warm cache (default: 1000)')
+    parser.add_argument('--regions', type=int, default=1,
+                        help='Regions in the warm cache (default: 1)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Times each command is started (default: 10)')
+    parser.add_argument('--heavy', default='boto,yaml,jinja2,subprocess,hashlib,shutil',
+                        help='Modules reported when a command imports them '
+                             '(default: boto,yaml,jinja2,subprocess,hashlib,shutil)')
+    parser.add_argument('--budget', type=float,
+                        help='Milliseconds ec2.py --list may take on top of the interpreter start')
+    parser.add_argument('--ini', default=ec2_inventory.EC2_INI,
+                        help='ec2.ini to start from (default: the inventory one)')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Override an ec2.ini option, may be repeated')
+    parser.add_argument('--warm', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.warm:
+        run_warm(json.loads(args.warm[0]), args.warm[1])
+        return 0
+
+    scenario = {'instances': args.instances, 'regions': args.regions, 'tags': 3,
+                'tag_values': 10, 'clusters': 3, 'zones': 3, 'rrsets': 50,
+                'latency': 0.0, 'ini': args.ini, 'set': args.set}
+    heavy = set(args.heavy.split(','))
+
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    try:
+        ini_path = warm_cache(scenario, workdir)
+        if ini_path is None:
+            return 1
+
+        env = dict(os.environ, EC2_INI_PATH=ini_path)
+        for name in ec2_inventory.SCOPE_ENVIRONMENT:
+            env.pop(name, None)
+
+        commands = [('python', [sys.executable, '-c', 'pass'], None),
+                    ('ec2.py --list', [sys.executable, ec2_inventory.EC2_PY, '--list'],
+                     (ec2_inventory.EC2_PY, ['--list'])),
+                    ('run.py --help', [sys.executable, RUN_PY, '--help'],
+                     (RUN_PY, ['--help']))]
+
+        results = {}
+        print '%-14s  %9s  %9s  %9s  %s' % ('command', 'min ms', 'median ms', 'max ms', 'heavy imports')
+        for name, command, probe in commands:
+            times = time_command(command, env, args.repeat)
+            if times is None:
+                return 1
+            results[name] = times[len(times) // 2]
+            loaded = ''
+            if probe is not None:
+                loaded = ' '.join(sorted(heavy.intersection(imported_modules(probe[0], probe[1], env)))) or '-'
+            print '%-14s  %9.1f  %9.1f  %9.1f  %s' % (name, times[0] * 1000, results[name] * 1000,
+                                                      times[-1] * 1000, loaded)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.budget is not None:
+        spent = (results['ec2.py --list'] - results['python']) * 1000
+        if spent > args.budget:
+            print
+            print 'ec2.py --list takes %.1f ms over the interpreter start, over the budget of %.1f ms' % (
+                spent, args.budget)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,6 +24,15 @@ you need to define:
 
 For more details, see: http://docs.pythonboto.org/en/latest/boto_config_tut.html
 
+To only look at the instances of a single deployment, define:
+
+    export EC2_INVENTORY_REGION=us-east-1
+    export EC2_INVENTORY_CLUSTER_ID=demo
+
+or pass --region / --cluster-id. Only that region is queried, and only
+instances tagged with scope_tag (see ec2.ini) equal to the cluster id are
+returned. Scoped inventories are cached separately.
+
 When run against a specific host, this script returns the following variables:
  - ec2_ami_launch_index
  - ec2_architecture
@@ -117,11 +126,11 @@ import sys
 import os
 import argparse
 import re
+import thread
+import mmap
+import struct
+import fcntl
 from time import time
-import boto
-from boto import ec2
-from boto import rds
-from boto import route53
 import ConfigParser
 from collections import defaultdict
 
@@ -130,6 +139,27 @@ try:
 except ImportError:
     import simplejson as json
 
+# boto takes longer to import than the rest of the script takes to serve
+# --list or --host from a valid cache, which Ansible asks for many times per
+# run. It is only imported by load_boto, before the first call to AWS.
+boto = None
+ec2 = None
+rds = None
+route53 = None
+
+
+def load_boto():
+    ''' Imports boto and the modules of the services the inventory calls '''
+
+    global boto, ec2, rds, route53
+    if boto is None:
+        import boto.ec2
+        import boto.rds
+        import boto.route53
+        ec2 = boto.ec2
+        rds = boto.rds
+        route53 = boto.route53
+
 
 class Ec2Inventory(object):
     def _empty_inventory(self):
@@ -145,15 +175,24 @@ class Ec2Inventory(object):
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Memoised results of to_safe and is_hostvar_wanted
+        self.safe_words = {}
+        self.hostvars_wanted = {}
+
+        # The inventory as written to the cache by a refresh, printed as is
+        # by --list
+        self.inventory_json = None
+
         # Read settings and parse CLI arguments
         self.read_settings()
         self.parse_cli_args()
+        self.apply_scope()
 
         # Cache
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
+            self.refresh_cache()
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            self.refresh_cache()
 
         # Data to print
         if self.args.host:
@@ -161,10 +200,15 @@ class Ec2Inventory(object):
 
         elif self.args.list:
             # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
-                data_to_print = self.get_inventory_from_cache()
+            if self.inventory_json is not None:
+                data_to_print = self.inventory_json
+            elif self.inventory == self._empty_inventory():
+                if not self.args.pretty:
+                    self.print_inventory_from_cache()
+                    return
+                data_to_print = self.json_format_dict(json.loads(self.get_inventory_from_cache()), True)
             else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+                data_to_print = self.json_format_dict(self.inventory, self.args.pretty)
 
         print data_to_print
 
@@ -203,6 +247,7 @@ class Ec2Inventory(object):
         configRegions = config.get('ec2', 'regions')
         configRegions_exclude = config.get('ec2', 'regions_exclude')
         if (configRegions == 'all'):
+            load_boto()
             if self.eucalyptus_host:
                 self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name)
             else:
@@ -212,6 +257,20 @@ class Ec2Inventory(object):
         else:
             self.regions = configRegions.split(",")
 
+        # A region listed twice would be queried twice and its hosts pushed
+        # into every group twice; keep the first occurrence only.
+        regions = []
+        for region in self.regions:
+            if region not in regions:
+                regions.append(region)
+        self.regions = regions
+
+        # Number of regions queried concurrently. 1 keeps the serial behaviour.
+        if config.has_option('ec2', 'region_workers'):
+            self.region_workers = max(1, config.getint('ec2', 'region_workers'))
+        else:
+            self.region_workers = 1
+
         # Destination addresses
         self.destination_variable = config.get('ec2', 'destination_variable')
         self.vpc_destination_variable = config.get('ec2', 'vpc_destination_variable')
@@ -229,7 +288,15 @@ class Ec2Inventory(object):
         self.route53_excluded_zones = []
         if config.has_option('ec2', 'route53_excluded_zones'):
             self.route53_excluded_zones.extend(
-                config.get('ec2', 'route53_excluded_zones', '').split(','))
+                [zone.strip() for zone in config.get('ec2', 'route53_excluded_zones', '').split(',')])
+        self.route53_included_zones = []
+        if config.has_option('ec2', 'route53_included_zones'):
+            self.route53_included_zones.extend(
+                [zone.strip() for zone in config.get('ec2', 'route53_included_zones', '').split(',')])
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
+        else:
+            self.route53_cache_max_age = 0
 
         # Include RDS instances?
         self.rds_enabled = True
@@ -251,10 +318,29 @@ class Ec2Inventory(object):
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
-        self.cache_path_cache = cache_dir + "/ansible-ec2.cache"
-        self.cache_path_index = cache_dir + "/ansible-ec2.index"
+        self.cache_dir = cache_dir
+        self.set_cache_paths('ansible-ec2')
+        self.cache_path_route53 = cache_dir + "/ansible-ec2.route53"
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        # 'indexed' also writes the hostvars of every host to a sorted binary
+        # table, so --host can answer without parsing the whole cache
+        if config.has_option('ec2', 'cache_backend'):
+            self.cache_backend = config.get('ec2', 'cache_backend')
+        else:
+            self.cache_backend = 'json'
+
+        # Incremental refresh: only re-describe instances whose state changed
+        # since the last snapshot, as long as that snapshot is recent enough
+        if config.has_option('ec2', 'incremental_refresh'):
+            self.incremental_refresh = config.getboolean('ec2', 'incremental_refresh')
+        else:
+            self.incremental_refresh = False
+        if config.has_option('ec2', 'incremental_max_age'):
+            self.incremental_max_age = config.getint('ec2', 'incremental_max_age')
+        else:
+            self.incremental_max_age = 3600
+
         # Configure nested groups instead of flat namespace.
         if config.has_option('ec2', 'nested_groups'):
             self.nested_groups = config.getboolean('ec2', 'nested_groups')
@@ -315,6 +401,27 @@ class Ec2Inventory(object):
                     continue
                 self.ec2_instance_filters[filter_key].append(filter_value)
 
+        # Only keep these hostvars ('prefix*' matches names starting with
+        # prefix); all of them when unset or empty
+        self.hostvars_include = None
+        if config.has_option('ec2', 'hostvars_include'):
+            self.hostvars_include = [name.strip() for name in config.get('ec2', 'hostvars_include').split(',')
+                                     if name.strip()] or None
+
+        # Number of instances per DescribeInstances page, 0 to get everything
+        # in a single response
+        if config.has_option('ec2', 'instance_page_size'):
+            self.instance_page_size = config.getint('ec2', 'instance_page_size')
+        else:
+            self.instance_page_size = 0
+
+        # Tag used to find the instances of a single cluster when running
+        # scoped (see --cluster-id)
+        if config.has_option('ec2', 'scope_tag'):
+            self.scope_tag = config.get('ec2', 'scope_tag')
+        else:
+            self.scope_tag = 'openshift-demo'
+
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
@@ -325,50 +432,472 @@ class Ec2Inventory(object):
                            help='Get all the variables about a specific instance')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                            help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+        parser.add_argument('--incremental', action='store_true', default=False,
+                           help='Refresh the cache from the last snapshot, only describing instances whose state changed (default: incremental_refresh from ec2.ini)')
+        parser.add_argument('--region', action='store',
+                           default=os.environ.get('EC2_INVENTORY_REGION'),
+                           help='Only query this region (default: $EC2_INVENTORY_REGION)')
+        parser.add_argument('--cluster-id', action='store',
+                           default=os.environ.get('EC2_INVENTORY_CLUSTER_ID'),
+                           help='Only return instances whose scope_tag is set to this cluster id (default: $EC2_INVENTORY_CLUSTER_ID)')
+        parser.add_argument('--route53-only-zone', action='store',
+                           default=os.environ.get('EC2_INVENTORY_ROUTE53_ZONE'),
+                           help='Only read this Route53 hosted zone (default: $EC2_INVENTORY_ROUTE53_ZONE)')
+        parser.add_argument('--pretty', action='store_true', default=False,
+                           help='Pretty print the JSON output and cache files (default: False)')
+        parser.add_argument('--verbose', action='store_true', default=False,
+                           help='Report API calls and processing time on stderr (default: False)')
         self.args = parser.parse_args()
 
+        # API calls made per region, reported with --verbose
+        self.api_calls = defaultdict(int)
+        self.api_calls_lock = thread.allocate_lock()
+
+
+    def apply_scope(self):
+        ''' Restricts the regions and instances to query when running scoped
+        to a single deployment. A scoped inventory is cached in its own files
+        so it never replaces the full inventory of the account. '''
+
+        self.scope_filters = {}
+        scope = []
+
+        if self.args.region:
+            self.regions = [self.args.region]
+            scope.append(self.args.region)
+
+        if self.args.cluster_id:
+            self.scope_filters['tag:' + self.scope_tag] = self.args.cluster_id
+            scope.append(self.args.cluster_id)
+            # RDS instances cannot be filtered by tag and never belong to a
+            # cluster
+            self.rds_enabled = False
+
+        if self.args.route53_only_zone and self.route53_enabled:
+            self.route53_included_zones = [self.args.route53_only_zone.rstrip('.')]
+            scope.append(self.route53_included_zones[0])
+
+        if scope:
+            suffix = re.sub("[^A-Za-z0-9_.\-]", "_", '-'.join(scope))
+            self.set_cache_paths('ansible-ec2-' + suffix)
+
+        self.instance_queries = self.build_instance_queries()
+
+
+    def build_instance_queries(self):
+        ''' Turns instance_filters and the scope filters into the smallest
+        list of DescribeInstances filter sets that returns the same instances.
+
+        Each instance_filters key is its own query (instances matching any of
+        them are returned) and the scope filters must match in every query.
+        Queries that can never match are dropped, queries whose results are
+        already covered by a less restrictive query are dropped, and queries
+        that only differ in the values of a single key are merged into one. '''
+
+        if self.ec2_instance_filters:
+            queries = [{key: set(values)} for key, values in self.ec2_instance_filters.iteritems()]
+        else:
+            queries = [{}]
+
+        scoped = []
+        for query in queries:
+            for key, value in self.scope_filters.iteritems():
+                if key in query:
+                    query[key] = query[key] & set([value])
+                else:
+                    query[key] = set([value])
+            if all(query.values()):
+                scoped.append(query)
+        queries = scoped
+
+        merged = True
+        while merged:
+            merged = False
+            for first in range(len(queries)):
+                for second in range(len(queries)):
+                    if first == second:
+                        continue
+                    a = queries[first]
+                    b = queries[second]
+                    if self.query_covers(b, a):
+                        del queries[first]
+                        merged = True
+                    elif set(a.keys()) == set(b.keys()):
+                        differing = [key for key in a if a[key] != b[key]]
+                        if len(differing) == 1:
+                            b[differing[0]] = b[differing[0]] | a[differing[0]]
+                            del queries[first]
+                            merged = True
+                    if merged:
+                        break
+                if merged:
+                    break
+
+        return [dict((key, sorted(values)) for key, values in query.iteritems())
+                for query in queries]
+
+
+    def query_covers(self, broad, narrow):
+        ''' Tells whether every instance matching the filter set narrow also
+        matches the filter set broad '''
+
+        for key, values in broad.iteritems():
+            if key not in narrow or not narrow[key] <= values:
+                return False
+        return True
+
+
+    def set_cache_paths(self, name):
+        ''' Sets the paths of the cache files, which are all named after name
+        and live in the cache directory '''
+
+        self.cache_path_cache = "%s/%s.cache" % (self.cache_dir, name)
+        self.cache_path_index = "%s/%s.index" % (self.cache_dir, name)
+        self.cache_path_state = "%s/%s.state" % (self.cache_dir, name)
+        self.cache_path_hosts = "%s/%s.hosts" % (self.cache_dir, name)
+        self.cache_path_lock = "%s/%s.lock" % (self.cache_dir, name)
+        self.cache_path_generation = "%s/%s.generation" % (self.cache_dir, name)
+
+
+    def refresh_cache(self):
+        ''' Refreshes the cache while holding its lock, so only one process
+        calls the API for a given cache at a time. The generation marker is
+        bumped after every refresh; a process that finds it changed once it
+        gets the lock reuses the cache another process just wrote instead of
+        refreshing again. '''
+
+        generation = self.read_cache_generation()
+
+        # imported before the region workers start
+        load_boto()
+
+        lock = open(self.cache_path_lock, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # read again under the lock, as refreshes may have been written
+            # while waiting for it
+            current = self.read_cache_generation()
+            if current != generation and self.is_cache_valid():
+                self.debug("reusing the cache refreshed by another process")
+                return
+            self.do_api_calls_update_cache()
+            self.write_to_cache(current + 1, self.cache_path_generation)
+        finally:
+            # closing the file releases the lock
+            lock.close()
+
+
+    def read_cache_generation(self):
+        ''' Returns the number of refreshes written to the cache, 0 if
+        unknown '''
+
+        try:
+            return int(open(self.cache_path_generation, 'r').read())
+        except (IOError, ValueError):
+            return 0
+
 
     def do_api_calls_update_cache(self):
         ''' Do API calls to each region, and save data in cache files '''
 
+        if (self.args.incremental or self.incremental_refresh) and self.load_snapshot():
+            self.do_api_calls_update_cache_incremental()
+            return
+
         if self.route53_enabled:
             self.get_route53_records()
 
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
+        self.instance_states = {}
+        results = self.run_per_region(self.fetch_region)
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
+        start = time()
+        for region, (states, instances, rds_instances) in results:
+            states.update((instance.id, instance.state) for instance in instances)
+            self.instance_states[region] = states
+            for instance in instances:
+                self.add_instance(instance, region)
+            for instance in rds_instances:
+                self.add_rds_instance(instance, region)
+        self.report_stats(time() - start)
+
+        self.inventory_json = self.write_to_cache(self.inventory, self.cache_path_cache)
+        self.write_to_cache(self.index, self.cache_path_index)
+        self.write_to_cache({'time': time(), 'states': self.instance_states}, self.cache_path_state)
+        if self.cache_backend == 'indexed':
+            self.write_host_table(self.inventory['_meta']['hostvars'], self.cache_path_hosts)
+
+
+    def load_snapshot(self):
+        ''' Loads the inventory, index and instance states written by the last
+        refresh. Returns False when there is no usable snapshot, in which case
+        a full refresh is needed. '''
+
+        if self.eucalyptus:
+            # Eucalyptus does not implement DescribeInstanceStatus
+            return False
+
+        for path in [self.cache_path_cache, self.cache_path_index, self.cache_path_state]:
+            if not os.path.isfile(path):
+                return False
+
+        try:
+            snapshot = json.loads(open(self.cache_path_state, 'r').read())
+            if snapshot['time'] + self.incremental_max_age < time():
+                return False
+            if sorted(snapshot['states'].keys()) != sorted(self.regions):
+                return False
+            self.inventory = json.loads(open(self.cache_path_cache, 'r').read())
+            self.load_index_from_cache()
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        self.snapshot_time = snapshot['time']
+        self.instance_states = snapshot['states']
+        return True
+
+
+    def do_api_calls_update_cache_incremental(self):
+        ''' Brings the snapshot loaded by load_snapshot up to date. Only the
+        state of every instance is listed; instances that are new or whose
+        state changed are described again and patched into the inventory,
+        and instances that disappeared are removed from it. Changes to the
+        tags of an instance that stays in the same state are only picked up
+        by a full refresh. '''
+
+        results = self.run_per_region(self.fetch_region_changes)
+
+        dests = {}
+        for dest, (region, instance_id) in self.index.iteritems():
+            dests[(region, instance_id)] = dest
+
+        # RDS endpoints are few and cheap to list, so they are always replaced
+        if self.rds_enabled:
+            for dest in list(self.inventory.get('rds', [])):
+                self.remove_host(dest)
+
+        # Route53 names are only needed for the hosts about to be added
+        if self.route53_enabled:
+            for region, (states, instances, rds_instances) in results:
+                if instances or rds_instances:
+                    self.get_route53_records()
+                    break
+
+        start = time()
+        for region, (states, instances, rds_instances) in results:
+            previous_states = self.instance_states[region]
+            for instance_id in previous_states:
+                if previous_states[instance_id] != states.get(instance_id):
+                    dest = dests.get((region, instance_id))
+                    if dest is not None:
+                        self.remove_host(dest)
+            for instance in instances:
+                self.add_instance(instance, region)
+            for instance in rds_instances:
+                self.add_rds_instance(instance, region)
+            self.instance_states[region] = states
+        self.report_stats(time() - start)
+
+        self.inventory_json = self.write_to_cache(self.inventory, self.cache_path_cache)
         self.write_to_cache(self.index, self.cache_path_index)
+        self.write_to_cache({'time': self.snapshot_time, 'states': self.instance_states}, self.cache_path_state)
+        if self.cache_backend == 'indexed':
+            self.write_host_table(self.inventory['_meta']['hostvars'], self.cache_path_hosts)
+
+
+    def fetch_region_changes(self, region):
+        ''' Compares the current state of every instance of a region with the
+        snapshot. Returns the current states, the instances that are new or
+        changed state (described again) and the RDS instances. '''
+
+        states = self.fetch_instance_states_by_region(region)
+        previous_states = self.instance_states[region]
+
+        changed_ids = [instance_id for instance_id, state in states.iteritems()
+                       if previous_states.get(instance_id) != state]
+
+        instances = []
+        if changed_ids:
+            instances = self.fetch_instances_by_region(region, sorted(changed_ids))
+
+        rds_instances = []
+        if self.rds_enabled:
+            rds_instances = self.fetch_rds_instances_by_region(region)
+        return states, instances, rds_instances
+
+
+    def fetch_instance_states_by_region(self, region):
+        ''' Returns a dict of instance ID to state name for every instance of
+        a region. DescribeInstanceStatus returns far less data per instance
+        than DescribeInstances. '''
+
+        try:
+            conn = self.connect_ec2(region)
+            states = {}
+            next_token = None
+            while True:
+                self.count_api_call(region)
+                statuses = conn.get_all_instance_status(max_results=1000,
+                                                        next_token=next_token,
+                                                        include_all_instances=True)
+                for status in statuses:
+                    states[status.id] = status.state_name
+                next_token = getattr(statuses, 'next_token', None)
+                if not next_token:
+                    return states
+
+        except boto.exception.BotoServerError, e:
+            print "Looks like AWS is down again:"
+            print e
+            sys.exit(1)
+
+
+    def remove_host(self, dest):
+        ''' Removes a host from the index, its hostvars and every group it
+        belongs to. Groups left without hosts or children are dropped, along
+        with their entry in the children of their parent groups. '''
+
+        self.index.pop(dest, None)
+        self.inventory['_meta']['hostvars'].pop(dest, None)
+
+        emptied = set()
+        for name, group in self.inventory.items():
+            if name == '_meta':
+                continue
+            hosts = group.get('hosts', []) if isinstance(group, dict) else group
+            while dest in hosts:
+                hosts.remove(dest)
+            if not hosts and not (isinstance(group, dict) and group.get('children')):
+                emptied.add(name)
+
+        while emptied:
+            for name in emptied:
+                del self.inventory[name]
+            parents = emptied
+            emptied = set()
+            for name, group in self.inventory.items():
+                if name == '_meta' or not isinstance(group, dict):
+                    continue
+                children = [child for child in group.get('children', []) if child not in parents]
+                if 'children' in group and len(children) != len(group['children']):
+                    group['children'] = children
+                    if not children and not group.get('hosts'):
+                        emptied.add(name)
+
+
+    def run_per_region(self, func):
+        ''' Calls func(region) for every configured region and returns a list
+        of (region, result) pairs in the order of self.regions. Up to
+        region_workers regions are queried at the same time; results are only
+        handed back once every region has answered, so callers can merge them
+        into the inventory without any locking. '''
+
+        workers = min(self.region_workers, len(self.regions))
+        if workers <= 1:
+            return [(region, func(region)) for region in self.regions]
+
+        import threading
+        import Queue
+
+        pending = Queue.Queue()
+        for region in self.regions:
+            pending.put(region)
+
+        results = {}
+        errors = {}
+
+        def worker():
+            while True:
+                try:
+                    region = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[region] = func(region)
+                except BaseException, e:
+                    # sys.exit() in a thread only ends that thread, so keep
+                    # the exception and re-raise it from the main thread
+                    errors[region] = e
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for region in self.regions:
+            if region in errors:
+                raise errors[region]
+
+        return [(region, results[region]) for region in self.regions]
+
+
+    def fetch_region(self, region):
+        ''' Returns the instance states of a region and its EC2 and RDS
+        instances as a tuple of a dict and two lists.
+
+        When the instances are scoped or filtered, the states of every
+        instance of the region are listed as well, so that an incremental
+        refresh from this snapshot does not take the instances outside the
+        scope for new ones and describe them. '''
+
+        states = {}
+        if self.instance_queries != [{}] and not self.eucalyptus:
+            states = self.fetch_instance_states_by_region(region)
+        instances = self.fetch_instances_by_region(region)
+        rds_instances = []
+        if self.rds_enabled:
+            rds_instances = self.fetch_rds_instances_by_region(region)
+        return states, instances, rds_instances
 
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
         region '''
 
-        try:
-            if self.eucalyptus:
-                conn = boto.connect_euca(host=self.eucalyptus_host)
-                conn.APIVersion = '2010-08-31'
-            else:
-                conn = ec2.connect_to_region(region)
+        for instance in self.fetch_instances_by_region(region):
+            self.add_instance(instance, region)
 
-            # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-            if conn is None:
-                print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-                sys.exit(1)
+    def connect_ec2(self, region):
+        ''' Returns an EC2 connection to a region, or exits if the region is
+        not supported '''
 
-            reservations = []
-            if self.ec2_instance_filters:
-                for filter_key, filter_values in self.ec2_instance_filters.iteritems():
-                    reservations.extend(conn.get_all_instances(filters = { filter_key : filter_values }))
-            else:
-                reservations = conn.get_all_instances()
+        load_boto()
+        if self.eucalyptus:
+            conn = boto.connect_euca(host=self.eucalyptus_host)
+            conn.APIVersion = '2010-08-31'
+        else:
+            conn = ec2.connect_to_region(region)
 
-            for reservation in reservations:
-                for instance in reservation.instances:
-                    self.add_instance(instance, region)
+        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
+        if conn is None:
+            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
+            sys.exit(1)
+
+        return conn
+
+    def fetch_instances_by_region(self, region, instance_ids=None):
+        ''' Makes an AWS EC2 API call to the list of instances in a particular
+        region and returns them without touching the inventory. If
+        instance_ids is given, only those instances are described. '''
+
+        try:
+            conn = self.connect_ec2(region)
+
+            # An instance matching several queries is only returned once
+            instances = []
+            seen = set()
+            returned = 0
+            for filters in self.instance_queries:
+                for reservation in self.get_all_reservations(conn, region, instance_ids, filters):
+                    for instance in reservation.instances:
+                        returned += 1
+                        if instance.id not in seen:
+                            seen.add(instance.id)
+                            instances.append(instance)
+
+            self.debug("%s: %d instances returned, %d unique" % (region, returned, len(instances)))
+            return instances
 
         except boto.exception.BotoServerError, e:
             if  not self.eucalyptus:
@@ -376,34 +905,61 @@ class Ec2Inventory(object):
             print e
             sys.exit(1)
 
+    def get_all_reservations(self, conn, region, instance_ids, filters):
+        ''' Returns the reservations matching a filter set, following
+        NextToken when instance_page_size is set. When instance_ids is given
+        they are described in chunks, as the API does not page those. '''
+
+        kwargs = {}
+        if filters:
+            kwargs['filters'] = filters
+
+        if instance_ids is not None:
+            reservations = []
+            for start in range(0, len(instance_ids), 200):
+                self.count_api_call(region)
+                reservations.extend(conn.get_all_reservations(instance_ids[start:start + 200], **kwargs))
+            return reservations
+
+        if self.instance_page_size:
+            kwargs['max_results'] = self.instance_page_size
+
+        reservations = []
+        next_token = None
+        while True:
+            self.count_api_call(region)
+            page = conn.get_all_reservations(next_token=next_token, **kwargs)
+            reservations.extend(page)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token or not self.instance_page_size:
+                return reservations
+
     def get_rds_instances_by_region(self, region):
         ''' Makes an AWS API call to the list of RDS instances in a particular
         region '''
 
+        for instance in self.fetch_rds_instances_by_region(region):
+            self.add_rds_instance(instance, region)
+
+    def fetch_rds_instances_by_region(self, region):
+        ''' Makes an AWS API call to the list of RDS instances in a particular
+        region and returns them without touching the inventory '''
+
         try:
             conn = rds.connect_to_region(region)
             if conn:
-                instances = conn.get_all_dbinstances()
-                for instance in instances:
-                    self.add_rds_instance(instance, region)
+                self.count_api_call(region)
+                return conn.get_all_dbinstances()
         except boto.exception.BotoServerError, e:
             if not e.reason == "Forbidden":
                 print "Looks like AWS RDS is down: "
                 print e
                 sys.exit(1)
+        return []
 
     def get_instance(self, region, instance_id):
         ''' Gets details about a specific instance '''
-        if self.eucalyptus:
-            conn = boto.connect_euca(self.eucalyptus_host)
-            conn.APIVersion = '2010-08-31'
-        else:
-            conn = ec2.connect_to_region(region)
-
-        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-        if conn is None:
-            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-            sys.exit(1)
+        conn = self.connect_ec2(region)
 
         reservations = conn.get_all_instances([instance_id])
         for reservation in reservations:
@@ -621,28 +1177,93 @@ class Ec2Inventory(object):
 
     def get_route53_records(self):
         ''' Get and store the map of resource records to domain names that
-        point to them. '''
+        point to them.
+
+        The records of each zone are cached in their own entry, along with the
+        zone's record set count from the zone listing. A zone whose count has
+        not changed and whose entry is younger than route53_cache_max_age is
+        not read again. '''
 
         r53_conn = route53.Route53Connection()
+        self.count_api_call('route53')
         all_zones = r53_conn.get_zones()
 
-        route53_zones = [ zone for zone in all_zones if zone.name[:-1]
-                          not in self.route53_excluded_zones ]
+        route53_zones = [ zone for zone in all_zones
+                          if self.is_route53_zone_wanted(zone.name[:-1]) ]
 
+        zone_cache = self.load_route53_cache()
         self.route53_records = {}
 
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            record_count = getattr(zone, 'resourcerecordsetcount', None)
+            entry = zone_cache.get(zone.id)
+            if entry is None or record_count is None or \
+               entry['record_count'] != record_count or \
+               entry['time'] + self.route53_cache_max_age <= time():
+                entry = {'record_count': record_count, 'time': time(),
+                         'records': self.get_route53_zone_records(r53_conn, zone)}
+                zone_cache[zone.id] = entry
+
+            for resource, names in entry['records'].iteritems():
+                self.route53_records.setdefault(resource, set())
+                self.route53_records[resource].update(names)
+
+        # Forget zones that were deleted
+        zone_ids = set(zone.id for zone in all_zones)
+        for zone_id in zone_cache.keys():
+            if zone_id not in zone_ids:
+                del zone_cache[zone_id]
+
+        if self.route53_cache_max_age:
+            self.write_to_cache(zone_cache, self.cache_path_route53)
+
+
+    def is_route53_zone_wanted(self, zone_name):
+        ''' Applies route53_included_zones and route53_excluded_zones to a
+        zone name '''
+
+        if zone_name in self.route53_excluded_zones:
+            return False
+        if self.route53_included_zones:
+            return zone_name in self.route53_included_zones
+        return True
+
+
+    def get_route53_zone_records(self, r53_conn, zone):
+        ''' Returns the map of resource records to the domain names that
+        point to them in a single zone '''
+
+        records = {}
+
+        self.count_api_call('route53')
+        rrsets = r53_conn.get_all_rrsets(zone.id)
 
-            for record_set in rrsets:
-                record_name = record_set.name
+        for record_set in rrsets:
+            record_name = record_set.name
 
-                if record_name.endswith('.'):
-                    record_name = record_name[:-1]
+            if record_name.endswith('.'):
+                record_name = record_name[:-1]
 
-                for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+            for resource in record_set.resource_records:
+                records.setdefault(resource, [])
+                if record_name not in records[resource]:
+                    records[resource].append(record_name)
+
+        return records
+
+
+    def load_route53_cache(self):
+        ''' Reads the per zone Route53 cache, empty when it is disabled or
+        cannot be read. The cache is shared by all scopes, as hosted zones
+        belong to the whole account. '''
+
+        if not self.route53_cache_max_age:
+            return {}
+
+        try:
+            return json.loads(open(self.cache_path_route53, 'r').read())
+        except (IOError, ValueError):
+            return {}
 
 
     def get_instance_route53_names(self, instance):
@@ -667,20 +1288,40 @@ class Ec2Inventory(object):
         return list(name_list)
 
 
+    # Attributes of boto instances that become hostvars with other names
+    HOSTVAR_SOURCES = {
+        'ec2__state': ['ec2_state', 'ec2_state_code'],
+        'ec2__previous_state': ['ec2_previous_state', 'ec2_previous_state_code'],
+        'ec2__placement': ['ec2_placement'],
+        'ec2_groups': ['ec2_security_group_ids', 'ec2_security_group_names'],
+    }
+
     def get_host_info_dict_from_instance(self, instance):
         instance_vars = {}
-        for key in vars(instance):
-            value = getattr(instance, key)
-            key = self.to_safe('ec2_' + key)
+        wanted = self.is_hostvar_wanted
+        for attr in vars(instance):
+            key = self.to_safe('ec2_' + attr)
+
+            # Skip attributes that would only produce unwanted variables
+            # before reading them; tags are filtered one by one below
+            if key != 'ec2_tags' and \
+               not [name for name in self.HOSTVAR_SOURCES.get(key, [key]) if wanted(name)]:
+                continue
+
+            value = getattr(instance, attr)
 
             # Handle complex types
             # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
             if key == 'ec2__state':
-                instance_vars['ec2_state'] = instance.state or ''
-                instance_vars['ec2_state_code'] = instance.state_code
+                if wanted('ec2_state'):
+                    instance_vars['ec2_state'] = instance.state or ''
+                if wanted('ec2_state_code'):
+                    instance_vars['ec2_state_code'] = instance.state_code
             elif key == 'ec2__previous_state':
-                instance_vars['ec2_previous_state'] = instance.previous_state or ''
-                instance_vars['ec2_previous_state_code'] = instance.previous_state_code
+                if wanted('ec2_previous_state'):
+                    instance_vars['ec2_previous_state'] = instance.previous_state or ''
+                if wanted('ec2_previous_state_code'):
+                    instance_vars['ec2_previous_state_code'] = instance.previous_state_code
             elif type(value) in [int, bool]:
                 instance_vars[key] = value
             elif type(value) in [str, unicode]:
@@ -694,15 +1335,18 @@ class Ec2Inventory(object):
             elif key == 'ec2_tags':
                 for k, v in value.iteritems():
                     key = self.to_safe('ec2_tag_' + k)
-                    instance_vars[key] = v
+                    if wanted(key):
+                        instance_vars[key] = v
             elif key == 'ec2_groups':
                 group_ids = []
                 group_names = []
                 for group in value:
                     group_ids.append(group.id)
                     group_names.append(group.name)
-                instance_vars["ec2_security_group_ids"] = ','.join([str(i) for i in group_ids])
-                instance_vars["ec2_security_group_names"] = ','.join([str(i) for i in group_names])
+                if wanted('ec2_security_group_ids'):
+                    instance_vars["ec2_security_group_ids"] = ','.join([str(i) for i in group_ids])
+                if wanted('ec2_security_group_names'):
+                    instance_vars["ec2_security_group_names"] = ','.join([str(i) for i in group_names])
             else:
                 pass
                 # TODO Product codes if someone finds them useful
@@ -710,29 +1354,56 @@ class Ec2Inventory(object):
                 #print type(value)
                 #print value
 
-        if self.route53_enabled:
+        if self.route53_enabled and wanted('ec2_route53_names'):
             instance_vars["ec2_route53_names"] = self.get_instance_route53_names(instance)
 
         return instance_vars
 
+
+    def is_hostvar_wanted(self, name):
+        ''' Tells whether a variable is kept in the hostvars, according to
+        hostvars_include. Answers are remembered, as the same names come up
+        for every instance. '''
+
+        if self.hostvars_include is None:
+            return True
+
+        if name not in self.hostvars_wanted:
+            wanted = False
+            for pattern in self.hostvars_include:
+                if pattern.endswith('*'):
+                    wanted = name.startswith(pattern[:-1])
+                else:
+                    wanted = name == pattern
+                if wanted:
+                    break
+            self.hostvars_wanted[name] = wanted
+        return self.hostvars_wanted[name]
+
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
+        if self.cache_backend == 'indexed':
+            host_info = self.lookup_host_table(self.args.host, self.cache_path_hosts)
+            if host_info is not None:
+                return host_info
+
         if len(self.index) == 0:
             # Need to load index from cache
             self.load_index_from_cache()
 
         if not self.args.host in self.index:
             # try updating the cache
-            self.do_api_calls_update_cache()
+            self.refresh_cache()
+            self.load_index_from_cache()
             if not self.args.host in self.index:
                 # host might not exist anymore
-                return self.json_format_dict({}, True)
+                return self.json_format_dict({}, self.args.pretty)
 
         (region, instance_id) = self.index[self.args.host]
 
         instance = self.get_instance(region, instance_id)
-        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), self.args.pretty)
 
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
@@ -762,6 +1433,19 @@ class Ec2Inventory(object):
         return json_inventory
 
 
+    def print_inventory_from_cache(self):
+        ''' Copies the cache file to stdout without loading it in memory '''
+
+        cache = open(self.cache_path_cache, 'r')
+        while True:
+            data = cache.read(65536)
+            if not data:
+                break
+            sys.stdout.write(data)
+        cache.close()
+        sys.stdout.write('\n')
+
+
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
@@ -770,20 +1454,133 @@ class Ec2Inventory(object):
         self.index = json.loads(json_index)
 
 
-    def write_to_cache(self, data, filename):
-        ''' Writes data in JSON format to a file '''
+    # Host table layout: a header ('EC2H', version, number of hosts), then
+    # one (key offset, key length, value offset, value length) entry per
+    # host sorted by host name, then the host names and their hostvars as
+    # JSON. Offsets are from the start of the file.
+    HOST_TABLE_HEADER = struct.Struct('<4sII')
+    HOST_TABLE_ENTRY = struct.Struct('<IIII')
+
+    def write_host_table(self, hostvars, filename):
+        ''' Writes the hostvars of every host to a host table. The file is
+        replaced atomically, as readers map it into memory. '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
+        items = sorted((host.encode('utf-8'), self.json_format_dict(host_vars).encode('utf-8'))
+                       for host, host_vars in hostvars.iteritems())
+
+        entries = []
+        blob = []
+        offset = self.HOST_TABLE_HEADER.size + self.HOST_TABLE_ENTRY.size * len(items)
+        for key, value in items:
+            entries.append(self.HOST_TABLE_ENTRY.pack(offset, len(key), offset + len(key), len(value)))
+            blob.append(key)
+            blob.append(value)
+            offset += len(key) + len(value)
+
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        table = open(tmp_filename, 'wb')
+        table.write(self.HOST_TABLE_HEADER.pack('EC2H', 1, len(items)))
+        table.write(''.join(entries))
+        table.write(''.join(blob))
+        table.close()
+        os.rename(tmp_filename, filename)
+
+
+    def lookup_host_table(self, host, filename):
+        ''' Returns the hostvars JSON of a host from a host table with a
+        binary search, or None if the table is missing, older than the cache
+        or does not know the host '''
+
+        try:
+            if os.path.getmtime(filename) < os.path.getmtime(self.cache_path_cache):
+                return None
+            table = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+
+        try:
+            if os.fstat(table.fileno()).st_size < self.HOST_TABLE_HEADER.size:
+                return None
+            data = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            table.close()
+
+        try:
+            magic, version, count = self.HOST_TABLE_HEADER.unpack_from(data, 0)
+            if magic != 'EC2H' or version != 1:
+                return None
+
+            key = host.encode('utf-8')
+            low = 0
+            high = count
+            while low < high:
+                middle = (low + high) // 2
+                entry = self.HOST_TABLE_HEADER.size + middle * self.HOST_TABLE_ENTRY.size
+                key_offset, key_len, value_offset, value_len = self.HOST_TABLE_ENTRY.unpack_from(data, entry)
+                current = data[key_offset:key_offset + key_len]
+                if current == key:
+                    return data[value_offset:value_offset + value_len]
+                elif current < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            return None
+        finally:
+            data.close()
+
+
+    def write_to_cache(self, data, filename):
+        ''' Writes data in JSON format to a file and returns the JSON. The
+        data goes to a temporary file that is then renamed over the cache
+        file, so readers see either the old or the new cache, never part of
+        one. '''
+
+        json_data = self.json_format_dict(data, self.args.pretty)
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        cache = open(tmp_filename, 'w')
         cache.write(json_data)
         cache.close()
+        os.rename(tmp_filename, filename)
+        return json_data
+
+
+    def count_api_call(self, region):
+        ''' Records an API call made for a region (or 'route53') '''
+
+        with self.api_calls_lock:
+            self.api_calls[region] += 1
+
+
+    def report_stats(self, processing_time):
+        ''' Reports the API calls made and the time spent turning instances
+        into inventory when running with --verbose '''
 
+        for region in sorted(self.api_calls):
+            self.debug("%s: %d API calls" % (region, self.api_calls[region]))
+        self.debug("%d API calls in total, inventory of %d hosts built in %.3fs" % (
+            sum(self.api_calls.values()), len(self.inventory['_meta']['hostvars']),
+            processing_time))
+
+
+    def debug(self, message):
+        ''' Writes a message to stderr when running with --verbose; stdout is
+        reserved for the inventory '''
+
+        if self.args.verbose:
+            sys.stderr.write("ec2.py: %s\n" % message)
+
+
+    UNSAFE_CHARACTERS = re.compile("[^A-Za-z0-9\-]")
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be
-        used as Ansible groups '''
+        used as Ansible groups. Results are remembered, as the same attribute
+        names and tag keys come up for every instance. '''
 
-        return re.sub("[^A-Za-z0-9\-]", "_", word)
+        safe = self.safe_words.get(word)
+        if safe is None:
+            safe = self.safe_words[word] = self.UNSAFE_CHARACTERS.sub("_", word)
+        return safe
 
 
     def json_format_dict(self, data, pretty=False):
@@ -793,9 +1590,9 @@ class Ec2Inventory(object):
         if pretty:
             return json.dumps(data, sort_keys=True, indent=2)
         else:
-            return json.dumps(data)
+            return json.dumps(data, separators=(',', ':'))
 
 
 # Run the script
-Ec2Inventory()
-
+if __name__ == '__main__':
+    Ec2Inventory()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:shiftwidth=4
+# pylint: disable=missing-docstring, unused-argument
+
+'''
+Records how long every task takes, overall and on each host, and writes the
+timeline of the run as JSON along with a table of the slowest tasks.
+
+It only does so when DEMO_TIMING_FILE names the JSON file to write, which
+run.py --timing sets for every ansible-playbook run. DEMO_TIMING_TOP sets the
+number of tasks in the table (20 by default).
+
+Ansible 1.9 calls the runner_on_* callbacks in the forked worker processes,
+so the end of each task on each host is appended to DEMO_TIMING_FILE.events
+and only read back by the main process once the playbook is done.
+'''
+
+import json
+import os
+import time
+
+
+class CallbackModule(object):
+
+    def __init__(self):
+        self.timeline_path = os.environ.get('DEMO_TIMING_FILE')
+        self.top = int(os.environ.get('DEMO_TIMING_TOP', '20'))
+        self.start = time.time()
+        self.tasks = []
+        self.play_name = None
+
+        if self.timeline_path:
+            self.events_path = self.timeline_path + '.events'
+            directory = os.path.dirname(os.path.abspath(self.timeline_path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            open(self.events_path, 'w').close()
+
+    def start_task(self, name):
+        if self.timeline_path:
+            self.tasks.append({'play': self.play_name, 'task': name,
+                               'start': time.time(), 'hosts': {}})
+
+    def end_task(self, host, status):
+        ''' Called in the worker processes: a single write to a file opened
+        for appending cannot interleave with the writes of other workers '''
+
+        if not self.timeline_path or not self.tasks:
+            return
+        event = json.dumps({'task': len(self.tasks) - 1, 'host': host,
+                            'status': status, 'end': time.time()})
+        fd = os.open(self.events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, event + '\n')
+        finally:
+            os.close(fd)
+
+    def read_events(self):
+        try:
+            with open(self.events_path) as events:
+                for line in events:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 0 <= event['task'] < len(self.tasks):
+                        task = self.tasks[event['task']]
+                        task['hosts'][event['host']] = {
+                            'status': event['status'],
+                            'seconds': round(event['end'] - task['start'], 3)}
+        except IOError:
+            pass
+
+    def write_timeline(self, end):
+        self.read_events()
+
+        # tasks run one after the other, each until the next one starts
+        for index, task in enumerate(self.tasks):
+            if index + 1 < len(self.tasks):
+                task_end = self.tasks[index + 1]['start']
+            else:
+                task_end = end
+            task['seconds'] = round(task_end - task['start'], 3)
+
+        playbook = getattr(self, 'playbook', None)
+        timeline = {'playbook': getattr(playbook, 'filename', None),
+                    'start': self.start,
+                    'end': end,
+                    'seconds': round(end - self.start, 3),
+                    'tasks': self.tasks}
+
+        with open(self.timeline_path + '.tmp', 'w') as timeline_file:
+            json.dump(timeline, timeline_file, indent=2)
+        os.rename(self.timeline_path + '.tmp', self.timeline_path)
+        os.remove(self.events_path)
+
+    def print_slowest_tasks(self):
+        slowest = sorted(self.tasks, key=lambda task: task['seconds'], reverse=True)[:self.top]
+        if not slowest:
+            return
+
+        print
+        print 'Slowest tasks:'
+        for task in slowest:
+            hosts = sorted(task['hosts'].items(), key=lambda host: host[1]['seconds'])
+            if hosts:
+                host = ' (slowest host %s: %.1fs)' % (hosts[-1][0], hosts[-1][1]['seconds'])
+            else:
+                host = ''
+            print '%9.1fs  %s | %s%s' % (task['seconds'], task['play'], task['task'], host)
+
+    def runner_on_failed(self, host, res, ignore_errors=False):
+        self.end_task(host, 'failed')
+
+    def runner_on_ok(self, host, res):
+        if res.get('changed'):
+            self.end_task(host, 'changed')
+        else:
+            self.end_task(host, 'ok')
+
+    def runner_on_skipped(self, host, item=None):
+        self.end_task(host, 'skipped')
+
+    def runner_on_unreachable(self, host, res):
+        self.end_task(host, 'unreachable')
+
+    def runner_on_async_failed(self, host, res, jid):
+        self.end_task(host, 'failed')
+
+    def runner_on_async_ok(self, host, res, jid):
+        self.end_task(host, 'ok')
+
+    def playbook_on_play_start(self, name):
+        self.play_name = name
+
+    def playbook_on_setup(self):
+        self.start_task('GATHERING FACTS')
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self.start_task(name)
+
+    def playbook_on_stats(self, stats):
+        if not self.timeline_path:
+            return
+        self.write_timeline(time.time())
+        self.print_slowest_tasks()
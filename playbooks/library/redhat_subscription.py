@@ -65,12 +65,52 @@ options:
             - Specify a subscription pool name to consume.  Regular expressions accepted.
         required: False
         default: '^$'
+    available_pools:
+        description:
+            - Pools available to the system as returned in C(available_pools) by an earlier run of the module on another host of the same account with the same C(pool), as a dict or as JSON. The pools are then not listed again while the listing is younger than C(available_pools_ttl).
+        required: False
+        default: null
+    available_pools_ttl:
+        description:
+            - Seconds for which a listing given in C(available_pools) is used
+        required: False
+        default: 600
+    retries:
+        description:
+            - Number of times C(subscription-manager register) and C(unregister) are retried when they fail with a transient error, such as rate limiting or a timeout
+        required: False
+        default: 5
+    retry_delay:
+        description:
+            - Seconds to wait before the first retry; the wait doubles with every retry, plus a random part so that hosts registering at the same time spread out
+        required: False
+        default: 5
+    repos:
+        description:
+            - Repositories to enable once the system is registered, every other one being disabled, in a single C(subscription-manager repos) call that is only made when the enabled repositories differ. The enabled repositories before and after are returned in C(repos_before) and C(repos_after).
+        required: False
+        default: null
+    state_file:
+        description:
+            - File in which the module records the state it last brought the system to. When the system is still registered with the same certificate, has the same subscriptions attached and repositories enabled, and the options describe the same state, the module returns at once without contacting the subscription service.
+        required: False
+        default: /var/lib/rhsm/ansible-redhat_subscription.json
+    force:
+        description:
+            - Ignore C(state_file) and check the registration and subscriptions
+        required: False
+        default: False
 '''
 
 EXAMPLES = '''
 # Register as user (joe_user) with password (somepass) and auto-subscribe to available content.
 - redhat_subscription: state=present username=joe_user password=somepass autosubscribe=true
 
+# Register, subscribe and enable the OpenShift repository only
+- redhat_subscription: state=present username=joe_user password=somepass
+                       pool='^OpenShift Enterprise'
+                       repos=rhel-7-server-ose-3.2-rpms
+
 # Register with activationkey (1-222333444) and consume subscriptions matching
 # the names (Red hat Enterprise Server) and (Red Hat Virtualization)
 - redhat_subscription: state=present
@@ -82,15 +122,48 @@ EXAMPLES = '''
 - redhat_subscription: state=present
                        activationkey=1-222333444
                        pool='^Red Hat Enterprise Server$'
+
+# List the available pools once, on the first host, and hand the listing to
+# the other hosts
+- redhat_subscription: state=present username=joe_user password=somepass
+                       pool='^Red Hat Enterprise Server$'
+  register: first_host
+  when: inventory_hostname == play_hosts[0]
+- redhat_subscription: state=present username=joe_user password=somepass
+                       pool='^Red Hat Enterprise Server$'
+                       available_pools='{{ hostvars[play_hosts[0]].first_host.available_pools | default({}) | to_json }}'
 '''
 
 import os
 import re
+import json
+import time
+import hashlib
+from cStringIO import StringIO
+import random
 import types
 import ConfigParser
 import shlex
 
 
+# Options that describe the state the module brings the system to; the
+# password is left out, a new one does not change that state
+DESIRED_STATE_PARAMS = ['username', 'server_hostname', 'server_insecure', 'rhsm_baseurl',
+                        'autosubscribe', 'activationkey', 'org_id', 'pool', 'pool_ids', 'repos']
+
+CONSUMER_CERT = '/etc/pki/consumer/cert.pem'
+
+# Holds a SERIAL.pem certificate for every attached subscription
+ENTITLEMENT_DIR = '/etc/pki/entitlement'
+
+REDHAT_REPO = '/etc/yum.repos.d/redhat.repo'
+
+# Output of subscription-manager failures that are worth retrying
+TRANSIENT_ERRORS = re.compile(r'rate limit|too many requests|\b(429|502|503|504)\b|timed out|timeout|'
+                              r'temporarily unavailable|service unavailable|unable to reach the server|'
+                              r'connection reset|remote server error|try again', re.IGNORECASE)
+
+
 class RegistrationBase(object):
     def __init__(self, module, username=None, password=None):
         self.module = module
@@ -102,9 +175,8 @@ class RegistrationBase(object):
 
     def enable(self):
         # Remove any existing redhat.repo
-        redhat_repo = '/etc/yum.repos.d/redhat.repo'
-        if os.path.isfile(redhat_repo):
-            os.unlink(redhat_repo)
+        if os.path.isfile(REDHAT_REPO):
+            os.unlink(REDHAT_REPO)
 
     def register(self):
         raise NotImplementedError("Must be implemented by a sub-class")
@@ -137,6 +209,13 @@ class Rhsm(RegistrationBase):
         RegistrationBase.__init__(self, module, username, password)
         self.config = self._read_config()
         self.module = module
+        self.retries = 5
+        self.retry_delay = 5
+        # listing of available pools handed to the module, and the one it
+        # fetched itself, as {'time': ..., 'pools': [...]}
+        self.shared_pools = None
+        self.shared_pools_ttl = 600
+        self.fetched_pools = None
 
     def _read_config(self, rhsm_conf='/etc/rhsm/rhsm.conf'):
         '''
@@ -230,7 +309,8 @@ class Rhsm(RegistrationBase):
             if password:
                 args.extend(['--password', password])
 
-        rc, stderr, stdout = self.module.run_command(args, check_rc=True)
+        # a registration that timed out may still have gone through
+        self.run_with_retries(args, done=lambda: self.is_registered)
 
     def unsubscribe(self, serials=None):
         '''
@@ -260,14 +340,144 @@ class Rhsm(RegistrationBase):
               * Exception - if error occurs while running command
         '''
         args = ['subscription-manager', 'unregister']
-        rc, stderr, stdout = self.module.run_command(args, check_rc=True)
+        self.run_with_retries(args, done=lambda: not self.is_registered)
+
+    def enabled_repos(self):
+        '''
+            Return the sorted IDs of the repositories enabled in redhat.repo,
+            which subscription-manager keeps up to date
+        '''
+        config = ConfigParser.RawConfigParser()
+        try:
+            config.read(REDHAT_REPO)
+        except ConfigParser.Error:
+            return []
+        return sorted(repo for repo in config.sections()
+                      if config.has_option(repo, 'enabled') and
+                      config.get(repo, 'enabled').strip() == '1')
+
+    def set_repos(self, repos):
+        '''
+            Enable the given repositories and disable every other one, with a
+            single subscription-manager call made only if the enabled ones
+            differ
+            Returns: the enabled repositories before and after
+            Raises:
+              * Exception - if error occurs while running command
+        '''
+        before = self.enabled_repos()
+        if set(before) == set(repos):
+            return before, before
+
+        args = ['subscription-manager', 'repos', '--disable=*']
+        args.extend(['--enable=%s' % repo for repo in repos])
+        self.run_with_retries(args, done=lambda: set(self.enabled_repos()) == set(repos))
+        return before, self.enabled_repos()
+
+    def attached_serials(self):
+        '''
+            Return the sorted serials of the entitlement certificates, one for
+            each attached subscription
+        '''
+        try:
+            names = os.listdir(ENTITLEMENT_DIR)
+        except OSError:
+            return []
+        return sorted(name[:-len('.pem')] for name in names
+                      if name.endswith('.pem') and not name.endswith('-key.pem'))
+
+    def fingerprint(self, params):
+        '''
+            Return a fingerprint of the desired state described by params, of
+            the consumer certificate the system is registered with and of the
+            subscriptions and repositories the system has, or None if it is
+            not registered. Subscriptions attached or removed and repositories
+            enabled or disabled outside the module change it.
+        '''
+        try:
+            cert = open(CONSUMER_CERT).read()
+        except IOError:
+            return None
+        state = dict((k, params.get(k)) for k in DESIRED_STATE_PARAMS)
+        state['attached'] = self.attached_serials()
+        state['enabled_repos'] = self.enabled_repos()
+        return hashlib.sha1(json.dumps(state, sort_keys=True) + cert).hexdigest()
+
+    def read_state(self, path):
+        try:
+            return json.load(open(path)).get('fingerprint')
+        except (IOError, ValueError, AttributeError):
+            return None
+
+    def write_state(self, path, params):
+        fingerprint = self.fingerprint(params)
+        if fingerprint is None:
+            return
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump({'fingerprint': fingerprint, 'time': time.time()}, f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def remove_state(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def run_with_retries(self, args, done):
+        '''
+            Run a subscription-manager command, retrying it with exponential
+            backoff while it fails with a transient error, unless done()
+            tells that a failed attempt still had its effect
+            Raises:
+              * Exception - if the command fails with any other error, or
+                            still fails after the last retry
+        '''
+        attempt = 0
+        while True:
+            rc, stdout, stderr = self.module.run_command(args, check_rc=False)
+            if rc == 0:
+                return
+            output = (stderr or stdout or '').strip()
+            if attempt >= self.retries or not TRANSIENT_ERRORS.search(output):
+                # the arguments are left out as they may hold the password
+                raise Exception("%s failed (rc=%s): %s" % (' '.join(args[:2]), rc, output))
+            delay = self.retry_delay * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay))
+            attempt += 1
+            if done():
+                return
 
     def subscribe_ids(self, pool_ids):
+        if not pool_ids:
+            return pool_ids
         items = ["--pool=%s" % p for p in pool_ids]
-        args = ['subscription-manager', 'subscribe'] + items
+        args = ['subscription-manager', 'attach'] + items
         rc, stdout, stderr = self.module.run_command(args, check_rc=True)
         return pool_ids
 
+    def available_pools(self, regexp):
+        '''
+            Return the pools available to the system whose name matches
+            regexp, from the listing handed to the module while it is younger
+            than shared_pools_ttl and was made for the same regexp, otherwise
+            from subscription-manager. A listing fetched here is kept in
+            fetched_pools for the module to return.
+        '''
+        shared = self.shared_pools
+        if shared and shared.get('pool') == regexp and \
+           time.time() - shared['time'] <= self.shared_pools_ttl:
+            return RhsmPools(self.module, listing=shared['pools'], regexp=regexp)
+
+        pools = RhsmPools(self.module, regexp=regexp)
+        self.fetched_pools = {'time': time.time(), 'pool': regexp,
+                              'pools': [p.to_dict() for p in pools]}
+        return pools
+
     def subscribe(self, regexp='^$', pool_ids=None):
         '''
             Subscribe current system to available pools matching the specified
@@ -278,7 +488,7 @@ class Rhsm(RegistrationBase):
         if pool_ids is not None:
             ids = pool_ids
         else:
-            ids = [p.get_pool_id() for p in RhsmPools(self.module).filter(regexp)]
+            ids = [p.get_pool_id() for p in self.available_pools(regexp)]
 
         return self.subscribe_ids(ids)
 
@@ -302,8 +512,7 @@ class Rhsm(RegistrationBase):
         if pool_ids is not None:
             available_pool_ids = pool_ids
         else:
-            available_pools = RhsmPools(self.module)
-            available_pool_ids = [p.get_pool_id() for p in available_pools.filter(regexp)]
+            available_pool_ids = [p.get_pool_id() for p in self.available_pools(regexp)]
 
         pools_to_subscribe = list(set(available_pool_ids) - set(pool_ids_to_keep))
         #raise Exception("pools_to_sub: %s" % pools_to_subscribe)
@@ -320,33 +529,105 @@ class RhsmPool(object):
     '''
         Convenience class for housing subscription information
     '''
+    __slots__ = ('_name', 'attributes')
 
-    def __init__(self, module, **kwargs):
-        self.module = module
-        for k,v in kwargs.items():
-            setattr(self, k, v)
+    def __init__(self, module=None, _name=None, **kwargs):
+        self._name = _name
+        self.attributes = kwargs
+
+    def __getattr__(self, key):
+        # fields such as Serial or PoolId, as listed by subscription-manager
+        try:
+            return self.attributes[key]
+        except KeyError:
+            raise AttributeError(key)
 
     def __str__(self):
-        return str(self.__getattribute__('_name'))
+        return str(self._name)
 
     def get_pool_id(self):
-        return getattr(self, 'PoolId', getattr(self, 'PoolID'))
+        return getattr(self, 'PoolId', getattr(self, 'PoolID', None))
+
+    def to_dict(self):
+        return dict(self.attributes, _name=self._name)
+
+
+def parse_pools(lines, regexp=None, pool_ids=None):
+    '''
+        Parse the output of subscription-manager list one line at a time and
+        yield an RhsmPool for each pool whose name matches regexp and, if
+        pool_ids is given, whose pool ID is one of them. The fields of pools
+        whose name or pool ID does not match are skipped rather than
+        collected, and no RhsmPool is built for them.
+    '''
+    r = regexp is not None and re.compile(regexp)
+    if pool_ids is not None:
+        pool_ids = set(pool_ids)
+
+    def wanted(fields):
+        return pool_ids is None or fields.get('PoolId', fields.get('PoolID')) in pool_ids
+
+    name = None
+    fields = None
+    provides = None
+    for line in lines:
+        # Remove leading+trailing whitespace
+        line = line.strip()
+        # An empty line implies the end of a output group
+        if not line:
+            continue
+        # If a colon ':' is found, parse
+        if ':' in line:
+            (key, value) = line.split(':', 1)
+            key = key.strip().replace(" ", "")  # To unify
+            value = value.strip()
+            if key in ['ProductName', 'SubscriptionName']:
+                if fields is not None and wanted(fields):
+                    yield RhsmPool(_name=name, **fields)
+                name = value
+                provides = None
+                # Remember the fields of pools that can match only
+                if r and not r.search(value):
+                    fields = None
+                else:
+                    fields = {}
+            elif fields is not None:
+                # Associate value with most recently recorded product
+                if key == 'Provides':
+                    provides = fields[key] = [value]
+                elif key in ['PoolId', 'PoolID'] and pool_ids is not None and value not in pool_ids:
+                    # The rest of a pool that is not wanted is skipped
+                    fields = provides = None
+                else:
+                    provides = None
+                    fields[key] = value
+        elif provides is not None:
+            # Associate value with the most recently recorded key
+            provides.append(line)
+
+    if fields is not None and wanted(fields):
+        yield RhsmPool(_name=name, **fields)
 
 
 class RhsmPools(object):
     """
         This class is used for manipulating pools subscriptions with RHSM
     """
-    def __init__(self, module, consumed=False):
+    def __init__(self, module, consumed=False, listing=None, regexp=None, pool_ids=None):
         self.module = module
-        self.products = self._load_product_list(consumed)
+        if listing is not None:
+            self.products = list(parse_listing(listing, regexp, pool_ids))
+        else:
+            self.products = self._load_product_list(consumed, regexp, pool_ids)
 
     def __iter__(self):
         return self.products.__iter__()
 
-    def _load_product_list(self, consumed=False):
+    def _load_product_list(self, consumed=False, regexp=None, pool_ids=None):
         """
-            Loads list of all available or consumed pools for system in data structure
+            Loads list of available or consumed pools for system in data structure,
+            keeping the ones whose name matches regexp and whose ID is in
+            pool_ids only, when given
 
             Args:
                 consumed(bool): if True list consumed  pools, else list available pools (default False)
@@ -358,42 +639,7 @@ class RhsmPools(object):
             args += " --available"
         rc, stdout, stderr = self.module.run_command(args, check_rc=True)
 
-        products = []
-        is_provides = False
-        for line in stdout.split('\n'):
-            # Remove leading+trailing whitespace
-            line = line.strip()
-            # An empty line implies the end of a output group
-            if len(line) == 0:
-                continue
-            # If a colon ':' is found, parse
-            elif ':' in line:
-                (key, value) = line.split(':',1)
-                key = key.strip().replace(" ", "")  # To unify
-                value = value.strip()
-                if key in ['ProductName', 'SubscriptionName']:
-                    # Remember the name for later processing
-                    products.append(RhsmPool(self.module, _name=value, key=value))
-                    is_provides = False
-                elif products:
-                    # Associate value with most recently recorded product
-                    if key == 'Provides':
-                        is_provides = True
-                        products[-1].__setattr__(key, [value])
-                    else:
-                        is_provides = False
-                        products[-1].__setattr__(key, value)
-                # FIXME - log some warning?
-                #else:
-                    # warnings.warn("Unhandled subscription key/value: %s/%s" % (key,value))
-            else:
-                if products and is_provides:
-                    # Associate value with the most recently recorded key
-                    products[-1].Provides.append(line)
-                # FIXME - log some warning?
-                #else:
-                    # warnings.warn("Unhandled subscription key/value: %s/%s" % (key,value))
-        return products
+        return list(parse_pools(StringIO(stdout), regexp, pool_ids))
 
     def filter_by_ids(self, pool_ids=None):
         '''
@@ -416,6 +662,21 @@ class RhsmPools(object):
                 yield product
 
 
+def parse_listing(listing, regexp=None, pool_ids=None):
+    '''
+        Yield the pools of a listing returned by the module in available_pools
+        that match regexp and pool_ids, like parse_pools
+    '''
+    r = regexp is not None and re.compile(regexp)
+    for fields in listing:
+        pool = RhsmPool(**fields)
+        if r and not r.search(pool._name):
+            continue
+        if pool_ids is not None and pool.get_pool_id() not in pool_ids:
+            continue
+        yield pool
+
+
 def main():
 
     # Load RHSM configuration from file
@@ -434,6 +695,15 @@ def main():
                     org_id = dict(default=None, required=False),
                     pool = dict(default='^$', required=False, type='str'),
                     pool_ids = dict(default=None, required=False, type='list'),
+                    # Ansible 1.9 turns templated values that look like a dict
+                    # into one, so either a dict or JSON text is accepted
+                    available_pools = dict(default=None, required=False),
+                    available_pools_ttl = dict(default=600, required=False, type='int'),
+                    retries = dict(default=5, required=False, type='int'),
+                    retry_delay = dict(default=5, required=False, type='int'),
+                    state_file = dict(default='/var/lib/rhsm/ansible-redhat_subscription.json', required=False),
+                    repos = dict(default=None, required=False, type='list'),
+                    force = dict(default=False, type='bool'),
                 ),
                 mutually_exclusive = [
                     ['pool', 'pool_ids']
@@ -441,6 +711,19 @@ def main():
             )
 
     rhn.module = module
+    rhn.retries = module.params['retries']
+    rhn.retry_delay = module.params['retry_delay']
+    rhn.shared_pools_ttl = module.params['available_pools_ttl']
+    shared_pools = module.params['available_pools']
+    if shared_pools:
+        if not isinstance(shared_pools, dict):
+            try:
+                shared_pools = json.loads(shared_pools)
+            except ValueError, e:
+                module.fail_json(msg="available_pools is not valid JSON: %s" % e)
+        # an empty listing, as from a skipped first host, is ignored
+        if isinstance(shared_pools, dict) and 'time' in shared_pools and 'pools' in shared_pools:
+            rhn.shared_pools = shared_pools
     state = module.params['state']
     username = module.params['username']
     password = module.params['password']
@@ -452,10 +735,33 @@ def main():
     org_id = module.params['org_id']
     pool = module.params['pool']
     pool_ids = module.params['pool_ids']
+    repos = module.params['repos']
+    state_file = module.params['state_file']
+    force = module.params['force']
+
+    def exit_registered(result):
+        # enable the repos, then record the state the system is in
+        if repos is not None:
+            try:
+                before, after = rhn.set_repos(repos)
+            except Exception, e:
+                module.fail_json(msg="Failed to enable repositories %s: %s" % (', '.join(repos), e))
+            result.update(repos_before=before, repos_after=after)
+            if before != after:
+                result['changed'] = True
+        if rhn.fetched_pools:
+            result['available_pools'] = rhn.fetched_pools
+        rhn.write_state(state_file, module.params)
+        module.exit_json(**result)
 
     # Ensure system is registered
     if state == 'present':
 
+        # Nothing to do when the last run left the system in the same state
+        fingerprint = rhn.fingerprint(module.params)
+        if not force and fingerprint is not None and rhn.read_state(state_file) == fingerprint:
+            module.exit_json(changed=False, msg="System already in the desired state.")
+
         # Check for missing parameters ...
         if not (activationkey or username or password):
             module.fail_json(msg="Missing arguments, must supply an activationkey (%s) or username (%s) and password (%s)" % (activationkey, username, password))
@@ -470,9 +776,9 @@ def main():
                 except Exception, e:
                     module.fail_json(msg="Failed to update subscriptions for '%s': %s" % (server_hostname, e))
                 else:
-                    module.exit_json(**result)
+                    exit_registered(result)
             else:
-                module.exit_json(changed=False, msg="System already registered.")
+                exit_registered(dict(changed=False, msg="System already registered."))
         else:
             try:
                 rhn.enable()
@@ -482,11 +788,12 @@ def main():
             except Exception, e:
                 module.fail_json(msg="Failed to register with '%s': %s" % (server_hostname, e))
             else:
-                module.exit_json(changed=True,
-                                 msg="System successfully registered to '%s'." % server_hostname,
-                                 subscribed_pool_ids=subscribed_pool_ids)
+                exit_registered(dict(changed=True,
+                                     msg="System successfully registered to '%s'." % server_hostname,
+                                     subscribed_pool_ids=subscribed_pool_ids))
     # Ensure system is *not* registered
     if state == 'absent':
+        rhn.remove_state(state_file)
         if not rhn.is_registered:
             module.exit_json(changed=False, msg="System already unregistered.")
         else:
@@ -501,4 +808,5 @@ def main():
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+from ansible import utils, errors
+import boto.vpc
+
+class LookupModule(object):
+    ''' Returns the ID of a default subnet of the default VPC of a region,
+    where instances get a public address and outside access can be allowed
+    by their security groups '''
+
+    def __init__(self, basedir=None, **kwargs):
+        self.basedir = basedir
+
+    def run(self, region, inject=None, **kwargs):
+        try:
+            conn = boto.vpc.connect_to_region(region)
+            subnets = conn.get_all_subnets(filters={'default-for-az': 'true'})
+        except Exception, e:
+            raise errors.AnsibleError("Could not lookup subnets for region: %s\nexception: %s" % (region, e))
+        if not subnets:
+            raise errors.AnsibleError("Region %s has no default VPC" % region)
+        subnet = sorted(subnets, key=lambda subnet: subnet.availability_zone)[0]
+        return [subnet.id]
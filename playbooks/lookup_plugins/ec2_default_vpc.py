@@ -0,0 +1,18 @@
+from ansible import utils, errors
+import boto.vpc
+
+class LookupModule(object):
+    ''' Returns the ID of the default VPC of a region '''
+
+    def __init__(self, basedir=None, **kwargs):
+        self.basedir = basedir
+
+    def run(self, region, inject=None, **kwargs):
+        try:
+            conn = boto.vpc.connect_to_region(region)
+            vpcs = conn.get_all_vpcs(filters={'isDefault': 'true'})
+        except Exception, e:
+            raise errors.AnsibleError("Could not lookup VPCs for region: %s\nexception: %s" % (region, e))
+        if not vpcs:
+            raise errors.AnsibleError("Region %s has no default VPC" % region)
+        return [vpcs[0].id]
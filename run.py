@@ -2,10 +2,701 @@
 # vim: sw=2 ts=2
 
 import click
+import json
 import os
+import re
 import sys
+import time
+
+# Modules that are only needed to run commands are imported by the functions
+# that use them, so that --help, --plan and invalid options return quickly.
+
+# Pods shown by each hexboard size
+hexboard_pods = [('tiny', 32), ('xsmall', 64), ('small', 108), ('medium', 266),
+                 ('large', 512), ('xlarge', 1026)]
+hexboard_sizes = [size for size, pods in hexboard_pods]
+
+# vCPUs and memory (MiB) of the instance types application nodes run on
+instance_types = {
+  't2.medium': (2, 4096), 't2.large': (2, 8192),
+  'm3.medium': (1, 3840), 'm3.large': (2, 7680), 'm3.xlarge': (4, 15360), 'm3.2xlarge': (8, 30720),
+  'm4.large': (2, 8192), 'm4.xlarge': (4, 16384), 'm4.2xlarge': (8, 32768),
+  'm4.4xlarge': (16, 65536), 'm4.10xlarge': (40, 163840),
+  'c4.large': (2, 3840), 'c4.xlarge': (4, 7680), 'c4.2xlarge': (8, 15360),
+  'c4.4xlarge': (16, 30720), 'c4.8xlarge': (36, 61440),
+  'r3.large': (2, 15616), 'r3.xlarge': (4, 31232), 'r3.2xlarge': (8, 62464),
+  'r3.4xlarge': (16, 124928), 'r3.8xlarge': (32, 249856),
+}
+
+# CPU (millicores) and memory (MiB) of a node taken by the OS, docker and the
+# node service rather than by pods
+NODE_RESERVED = {'cpu': 500, 'memory': 1024}
+
+# CPU (millicores) and memory (MiB) a hexboard pod, a node.js process, uses
+# at rest. The template requests nothing, so its pods are BestEffort and the
+# scheduler only holds them to max-pods; this is what packs the nodes
+# instead, for the resources the template sets no request for.
+BEST_EFFORT_FOOTPRINT = {'cpu': 25, 'memory': 96}
+
+class CommandResult(object):
+  ''' Outcome of a command run by run_command '''
+
+  def __init__(self, args, exit_code, start, end):
+    self.args = args
+    self.exit_code = exit_code
+    self.start = start
+    self.end = end
+    self.seconds = end - start
+
+  @property
+  def ok(self):
+    return self.exit_code == 0
+
+def run_command(args, log, echo=True):
+  ''' Runs a command without a shell, writing each line of its output to the
+  log with a timestamp, and to the console too when echo is set '''
+
+  import pipes
+  import subprocess
+
+  start = time.time()
+  log.write('%s $ %s\n' % (time.strftime('%H:%M:%S'), ' '.join(pipes.quote(arg) for arg in args)))
+  try:
+    # Python commands would otherwise hold their output back in a pipe
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+  except OSError, e:
+    log.write('%s %s: %s\n' % (time.strftime('%H:%M:%S'), args[0], e))
+    click.echo('Could not run %s: %s' % (args[0], e))
+    return CommandResult(args, 127, start, time.time())
+
+  for line in iter(process.stdout.readline, ''):
+    line = '%s %s' % (time.strftime('%H:%M:%S'), line.rstrip('\n'))
+    log.write(line + '\n')
+    log.flush()
+    if echo:
+      click.echo(line)
+  process.wait()
+
+  # a command killed by a signal exits like it would from a shell
+  exit_code = process.returncode
+  if exit_code < 0:
+    exit_code = 128 - exit_code
+  return CommandResult(args, exit_code, start, time.time())
+
+def write_extra_vars(cluster_id, extra_vars):
+  ''' Writes the variables passed to ansible-playbook as JSON, readable by the
+  user only as they include passwords, and returns the path of the file '''
+
+  path = '.ansible/extra-vars-%s.json' % cluster_id
+  if not os.path.isdir('.ansible'):
+    os.makedirs('.ansible')
+  fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+  with os.fdopen(fd, 'w') as f:
+    json.dump(extra_vars, f, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+  return path
+
+def refresh_inventory(log, verbose):
+  ''' Refreshes the inventory cache; only instances that changed state since
+  the previous refresh are described again. Its output, the whole
+  inventory, is discarded; its errors are logged, and shown in verbose
+  mode. Returns its CommandResult. '''
+
+  import subprocess
+
+  args = ['inventory/aws/hosts/ec2.py', '--refresh-cache', '--incremental']
+  start = time.time()
+  log.write('%s $ %s\n' % (time.strftime('%H:%M:%S'), ' '.join(args)))
+  try:
+    with open(os.devnull, 'w') as devnull:
+      process = subprocess.Popen(args, stdout=devnull, stderr=subprocess.PIPE)
+      errors = process.communicate()[1]
+  except OSError, e:
+    log.write('%s %s: %s\n' % (time.strftime('%H:%M:%S'), args[0], e))
+    return CommandResult(args, 127, start, time.time())
+
+  for line in errors.splitlines():
+    line = '%s %s' % (time.strftime('%H:%M:%S'), line)
+    log.write(line + '\n')
+    if verbose > 0:
+      click.echo(line)
+  if process.returncode != 0:
+    log.write('%s %s exited with %d\n' % (time.strftime('%H:%M:%S'), args[0], process.returncode))
+  log.flush()
+  return CommandResult(args, process.returncode, start, time.time())
+
+def run_playbook(playbook, extra_vars_file, facts_dir, log, verbose, refresh=True):
+  ''' Refreshes the inventory unless refresh is unset, drops cached facts and
+  runs a playbook, returning the CommandResult of ansible-playbook '''
+
+  import pipes
+  import shutil
+
+  # refresh the inventory cache to prevent stale hosts from
+  # interferring with re-running
+  if refresh:
+    refresh_inventory(log, verbose)
+
+  # remove any cached facts to prevent stale data during a re-run
+  shutil.rmtree(facts_dir, ignore_errors=True)
+
+  args = ['ansible-playbook', '-i', 'inventory/aws/hosts', '-e', '@' + extra_vars_file, playbook]
+
+  if verbose > 0:
+    args.append('-' + 'v' * verbose)
+    click.echo('We are running: %s' % ' '.join(pipes.quote(arg) for arg in args))
+
+  return run_command(args, log)
+
+def validate_params(params):
+  ''' Returns the problems with the options of a run, all at once '''
+
+  errors = []
+
+  # Cannot run cleanup with no-confirm
+  if params['cleanup'] and params['no_confirm']:
+    errors.append('Cannot use --cleanup and --no-confirm as it is not safe.')
+
+  # If skipping subscription management, must have cert repos enabled
+  # If cleaning up, this is ok
+  if not params['cleanup']:
+    if params['skip_subscription_management'] and not params['use_certificate_repos']:
+      errors.append('Cannot skip subscription management without using certificate repos.')
+
+  # If using subscription management, cannot use certificate repos
+  if not params['skip_subscription_management'] and params['use_certificate_repos']:
+    errors.append('Must skip subscription management when using certificate repos')
+
+  # User must supply a repo URL if using certificate repos
+  if params['use_certificate_repos'] and params['aos_repo'] is None:
+    errors.append('Must provide a repo URL via --aos-repo when using certificate repos')
+
+  # User must supply kerberos user and token with --prerelease
+  if params['prerelease'] and (params['kerberos_user'] is None or params['kerberos_token'] is None):
+    errors.append('Must provider --kerberos-user / --kerberos-token with --prerelease')
+
+  # A batch provisions several clusters with the same options
+  if params['clusters'] and params['cluster_count']:
+    errors.append('Cannot use --clusters and --cluster-count together')
+  if (params['clusters'] or params['cluster_count']) and \
+     (params['cleanup'] or params['debug_playbook'] or params['bake_ami']):
+    errors.append('Cannot use --cleanup, --debug-playbook or --bake-ami when provisioning several clusters')
+
+  # --bake-ami makes the AMI that --baked-ami launches from
+  if params['bake_ami'] and params['baked_ami']:
+    errors.append('Cannot use --bake-ami and --baked-ami together')
+
+  # check for AWS access info, which --help and --plan do not need
+  if not params['plan'] and (os.getenv('AWS_ACCESS_KEY_ID') is None or os.getenv('AWS_SECRET_ACCESS_KEY') is None):
+    errors.append('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY **MUST** be exported as environment variables.')
+
+  return errors
+
+# Options that choose what a run does rather than describe the cluster: they
+# are neither set by profiles nor kept with the parameters of a cluster
+RUN_OPTIONS = ['cluster_id', 'no_confirm', 'cleanup', 'debug_playbook', 'run_only_smoke_tests',
+               'pipeline', 'resume', 'bake_ami', 'timing', 'plan', 'clusters', 'cluster_count',
+               'batch_workers', 'profile', 'verbose']
+
+def load_profile(name):
+  ''' Returns the option values of a profile: a YAML or INI file (with a
+  [demo] section), given by path or by name in profiles/ '''
+
+  candidates = [name] + ['profiles/%s%s' % (name, ext) for ext in ['.yml', '.yaml', '.ini']]
+  paths = [path for path in candidates if os.path.isfile(path)]
+  if not paths:
+    raise click.UsageError('No profile %s, looked for %s' % (name, ', '.join(candidates)))
+  path = paths[0]
+
+  if path.endswith('.ini'):
+    import ConfigParser
+    config = ConfigParser.SafeConfigParser()
+    config.read(path)
+    if not config.has_section('demo'):
+      raise click.UsageError('Profile %s has no [demo] section' % path)
+    values = dict(config.items('demo'))
+  else:
+    import yaml
+    with open(path) as f:
+      values = yaml.safe_load(f) or {}
+    if not isinstance(values, dict):
+      raise click.UsageError('Profile %s must map options to values' % path)
+
+  values = dict((key.replace('-', '_'), value) for key, value in values.items())
+  options = set(param.name for param in launch_demo_env.params if param.expose_value) - set(RUN_OPTIONS)
+  unknown = sorted(set(values) - options - set(['cluster_id']))
+  if unknown:
+    raise click.UsageError('Unknown options in profile %s: %s' % (path, ', '.join(unknown)))
+  return values
+
+def params_path(cluster_id):
+  return '.ansible/params/%s.json' % cluster_id
+
+def load_params(cluster_id):
+  ''' Returns the option values of the last run for a cluster '''
+
+  try:
+    with open(params_path(cluster_id)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+def save_params(cluster_id, values):
+  ''' Keeps the option values of a run, prompts answered, readable by the
+  user only as they include passwords '''
+
+  path = params_path(cluster_id)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  params = dict((param.name, values.get(param.name)) for param in launch_demo_env.params
+                if param.expose_value and param.name not in RUN_OPTIONS)
+  fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+  with os.fdopen(fd, 'w') as f:
+    json.dump(params, f, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+
+def resolve_defaults(args):
+  ''' Returns the defaults of the options of run.py: the values kept from the
+  last run for the cluster, overridden by those of the profile. The command
+  line and OSE_DEMO_ variables override both; as click prefers defaults to
+  environment variables, options set in the environment are left out. '''
+
+  def environment(values):
+    return dict((name, value) for name, value in values.items()
+                if value is not None and 'OSE_DEMO_%s' % name.upper() not in os.environ)
+
+  def parse(default_map):
+    return launch_demo_env.make_context('run.py', list(args), resilient_parsing=True,
+                                        auto_envvar_prefix='OSE_DEMO',
+                                        default_map=default_map).params
+
+  profile = {}
+  name = parse(None).get('profile')
+  if name:
+    profile = environment(load_profile(name))
+
+  # the profile may name the cluster
+  defaults = environment(load_params(parse(profile)['cluster_id']))
+  defaults.update(profile)
+  return defaults
+
+def batch_environment(values):
+  ''' Returns the environment of the run.py processes of a batch: every option
+  of this run goes through its OSE_DEMO_ variable, so that answers to
+  prompts and passwords are not on their command lines '''
+
+  env = dict(os.environ)
+  for param in launch_demo_env.params:
+    if param.name in ['cluster_id', 'clusters', 'cluster_count', 'batch_workers', 'no_confirm', 'profile']:
+      continue
+    name = 'OSE_DEMO_%s' % param.name.upper()
+    value = values.get(param.name)
+    if value is None:
+      env.pop(name, None)
+    elif value is True or value is False:
+      env[name] = str(int(value))
+    else:
+      env[name] = str(value)
+  return env
+
+def run_batch(cluster_ids, values, workers, stages):
+  ''' Provisions clusters with one run.py process each, running at most
+  workers of them at a time, and prints a summary of their results. Returns
+  the number of clusters that failed. '''
+
+  import subprocess
+
+  env = batch_environment(values)
+  started = time.strftime('%Y%m%d-%H%M%S')
+  pending = list(cluster_ids)
+  running = {}
+  results = {}
+
+  def progress(message):
+    click.echo('%s [%d/%d done, %d running] %s' % (time.strftime('%H:%M:%S'), len(results),
+                                                   len(cluster_ids), len(running), message))
+
+  while pending or running:
+    while pending and len(running) < workers:
+      cluster_id = pending.pop(0)
+      output_path = '.ansible/logs/%s/batch-%s.out' % (cluster_id, started)
+      if not os.path.isdir(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+      output = open(output_path, 'w')
+      process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--cluster-id', cluster_id, '--no-confirm'],
+                                 stdin=open(os.devnull), stdout=output, stderr=subprocess.STDOUT,
+                                 env=env)
+      output.close()
+      running[cluster_id] = (process, time.time(), output_path)
+      progress('%s started, output in %s' % (cluster_id, output_path))
+
+    time.sleep(1)
+
+    for cluster_id, (process, start, output_path) in running.items():
+      if process.poll() is None:
+        continue
+      del running[cluster_id]
+      exit_code = process.returncode
+      if exit_code < 0:
+        exit_code = 128 - exit_code
+      results[cluster_id] = (exit_code, time.time() - start, output_path)
+      if exit_code == 0:
+        progress('%s provisioned in %s' % (cluster_id, format_seconds(time.time() - start)))
+      else:
+        progress('%s failed with exit code %d after %s' % (cluster_id, exit_code,
+                                                           format_seconds(time.time() - start)))
+
+  header = ('cluster', 'result', 'stages', 'time', 'output')
+  rows = []
+  for cluster_id in cluster_ids:
+    exit_code, seconds, output_path = results[cluster_id]
+    finished = load_checkpoint(cluster_id)
+    rows.append((cluster_id,
+                 'ok' if exit_code == 0 else 'failed (%d)' % exit_code,
+                 '%d/%d' % (len([stage for stage in stages if stage in finished]), len(stages)),
+                 format_seconds(seconds),
+                 output_path))
+  widths = [max(len(row[column]) for row in rows + [header]) for column in range(len(header))]
+  click.echo('')
+  for row in [header] + rows:
+    click.echo('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+  return len([result for result in results.values() if result[0] != 0])
+
+BAKED_AMIS = '.ansible/baked_amis.json'
+
+# what the hosts launched from an AMI baked by playbooks/bake_ami.yml skip,
+# passed to the playbooks as baked_skips
+BAKED_STEPS = ['install_ntp', 'pull_images']
+
+def load_baked_amis():
+  ''' Returns the AMIs baked by --bake-ami, by region and package version '''
+
+  try:
+    with open(BAKED_AMIS) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+def record_baked_ami(region, package_version, ami, source_ami):
+  baked_amis = load_baked_amis()
+  baked_amis.setdefault(region, {})[package_version] = {'ami': ami,
+                                                        'source_ami': source_ami,
+                                                        'baked': time.time()}
+  if not os.path.isdir(os.path.dirname(BAKED_AMIS)):
+    os.makedirs(os.path.dirname(BAKED_AMIS))
+  with open(BAKED_AMIS + '.tmp', 'w') as f:
+    json.dump(baked_amis, f, indent=2, sort_keys=True)
+  os.rename(BAKED_AMIS + '.tmp', BAKED_AMIS)
+
+def baked_stage_skips(inventory, cluster_id, baked_ami_ids):
+  ''' Returns the steps of BAKED_STEPS the hosts of a cluster can skip, given
+  the output of ec2.py --list and the AMIs baked for the cluster's region and
+  package version. The steps are skipped for every host or none, so a single
+  host launched from another image makes all of them run. '''
+
+  group = inventory.get(re.sub('[^A-Za-z0-9\-]', '_', 'tag_openshift-demo_' + cluster_id), [])
+  if isinstance(group, dict):
+    group = group.get('hosts', [])
+  hostvars = inventory.get('_meta', {}).get('hostvars', {})
+
+  if not group:
+    return []
+  for host in group:
+    if hostvars.get(host, {}).get('ec2_image_id') not in baked_ami_ids:
+      return []
+  return list(BAKED_STEPS)
+
+def read_inventory(log):
+  ''' Returns the inventory, served from the cache of the last refresh '''
+
+  import subprocess
+
+  args = ['inventory/aws/hosts/ec2.py', '--list']
+  log.write('%s $ %s\n' % (time.strftime('%H:%M:%S'), ' '.join(args)))
+  process = subprocess.Popen(args, stdout=subprocess.PIPE)
+  output = process.communicate()[0]
+  try:
+    return json.loads(output)
+  except ValueError:
+    return {}
+
+def parse_quantity(value, resource):
+  ''' Converts a Kubernetes quantity to millicores for cpu and to MiB for
+  memory '''
+
+  value = str(value)
+  if resource == 'cpu':
+    if value.endswith('m'):
+      return float(value[:-1])
+    return float(value) * 1000
+  for suffix, factor in [('Ki', 1.0 / 1024), ('Mi', 1), ('Gi', 1024), ('Ti', 1024 * 1024),
+                         ('K', 1000.0 / 1024 ** 2), ('M', 1000.0 ** 2 / 1024 ** 2),
+                         ('G', 1000.0 ** 3 / 1024 ** 2), ('T', 1000.0 ** 4 / 1024 ** 2)]:
+    if value.endswith(suffix):
+      return float(value[:-len(suffix)]) * factor
+  return float(value) / 1024 ** 2
+
+def hexboard_pod_requests():
+  ''' Returns the cpu and memory taken by each hexboard pod: its requests in
+  the container of playbooks/templates/hexboard_template.json.j2, or
+  BEST_EFFORT_FOOTPRINT for the resources it requests nothing for. Its
+  template values are all within strings, so it loads as JSON. '''
+
+  requests = dict(BEST_EFFORT_FOOTPRINT)
+  with open('playbooks/templates/hexboard_template.json.j2') as f:
+    template = json.load(f)
+  for item in template['items']:
+    if item['kind'] != 'DeploymentConfig':
+      continue
+    for container in item['spec']['template']['spec']['containers']:
+      for resource, value in container.get('resources', {}).get('requests', {}).items():
+        if resource in requests:
+          requests[resource] = parse_quantity(value, resource)
+  return requests
+
+def node_max_pods():
+  ''' Returns the max-pods kubelet argument set by playbooks/openshift_setup.yml '''
+
+  with open('playbooks/openshift_setup.yml') as f:
+    match = re.search(r'max-pods:\s*-\s*"?(\d+)', f.read())
+  return int(match.group(1)) if match else 110
+
+def app_node_system_pods(num_nodes, num_infra):
+  ''' Returns the pods other than the hexboard ones that run on the
+  application nodes: fluentd on every node, the hexboard server with its
+  build and deployer, and the router and registry when
+  playbooks/openshift_setup.yml does not select other nodes for them '''
+
+  with open('playbooks/openshift_setup.yml') as f:
+    setup = f.read()
+
+  def selector(name):
+    match = re.search(r'%s:\s*"?([^"\n]*)' % name, setup)
+    return match.group(1).strip() if match else None
+
+  pods = num_nodes + 3
+  default_selector = selector('osm_default_node_selector')
+  if selector('openshift_hosted_router_selector') in (None, default_selector):
+    pods += num_infra
+  if selector('openshift_hosted_registry_selector') in (None, default_selector):
+    pods += 1
+  return pods
+
+def hexboard_capacity(num_nodes, num_infra, node_instance_type):
+  ''' Returns how many hexboard pods fit on the application nodes next to
+  their system pods, how many fit on each node, what bounds them (max-pods,
+  cpu or memory) and the system pods. Only max-pods is known for instance
+  types missing from instance_types. '''
+
+  per_node = node_max_pods()
+  bound = 'max-pods'
+  if node_instance_type in instance_types:
+    vcpus, memory = instance_types[node_instance_type]
+    requests = hexboard_pod_requests()
+    allocatable = {'cpu': vcpus * 1000 - NODE_RESERVED['cpu'],
+                   'memory': memory - NODE_RESERVED['memory']}
+    for resource in ['cpu', 'memory']:
+      if requests[resource] > 0:
+        pods = max(int(allocatable[resource] // requests[resource]), 0)
+        if pods < per_node:
+          per_node = pods
+          bound = resource
+  system_pods = app_node_system_pods(num_nodes, num_infra)
+  return max(num_nodes * per_node - system_pods, 0), per_node, bound, system_pods
+
+def fit_hexboard(capacity):
+  ''' Returns the largest hexboard size whose pods fit in capacity, or the
+  smallest one when none does '''
+
+  fitting = [size for size, pods in hexboard_pods if pods <= capacity]
+  return fitting[-1] if fitting else hexboard_pods[0][0]
+
+def load_stage_history():
+  ''' Returns the durations of the stages that finished in runs recorded by
+  --timing, by stage name '''
+
+  history = {}
+  timing_root = '.ansible/timing'
+  if not os.path.isdir(timing_root):
+    return history
+  for cluster_id in os.listdir(timing_root):
+    cluster_dir = os.path.join(timing_root, cluster_id)
+    if not os.path.isdir(cluster_dir):
+      continue
+    for run in os.listdir(cluster_dir):
+      try:
+        with open(os.path.join(cluster_dir, run, 'stages.json')) as f:
+          stages = json.load(f)['stages']
+      except (IOError, ValueError, KeyError):
+        continue
+      for stage in stages:
+        if stage.get('result') == 0 and stage.get('seconds') is not None:
+          history.setdefault(stage['stage'], []).append(stage['seconds'])
+  return history
+
+def plan_cloudformation_parameters(extra_vars):
+  ''' Renders the template parameters of playbooks/tasks/cloudformation.yml
+  with the variables of a run, without calling AWS: lookups and the user data
+  are only named '''
+
+  import jinja2
+  import yaml
+
+  with open('playbooks/tasks/cloudformation.yml') as f:
+    task = yaml.safe_load(f)[0]['cloudformation']
+  with open('playbooks/vars.yml') as f:
+    variables = yaml.safe_load(f)
+
+  env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+  env.filters['b64encode'] = lambda value: '%s, base64 encoded' % value
+
+  def lookup(kind, name, *args):
+    if kind == 'template':
+      return '<%s>' % os.path.basename(name)
+    return '<%s lookup of %s at run time>' % (kind, name)
+
+  variables.update(extra_vars)
+  variables['lookup'] = lookup
+  variables['vpc_subnet_azs'] = lookup('ec2_zones_by_region', extra_vars['ec2_region'])
+  variables['vpc_subnet_count'] = 1
+
+  def render(value):
+    # values of vars.yml are templates too
+    for i in range(5):
+      if not isinstance(value, basestring) or '{{' not in value:
+        break
+      try:
+        value = env.from_string(value).render(variables)
+      except jinja2.TemplateError, e:
+        return '%s (cannot be resolved offline: %s)' % (value, e)
+    return value
+
+  parameters = []
+  for name, value in task['template_parameters'].items():
+    parameters.append((name, render(value)))
+  return render(task['stack_name']), sorted(parameters)
+
+def print_plan(runs, stage_results, extra_vars, host_counts, cluster_ids):
+  ''' Prints what a run would do, without running anything or calling AWS '''
+
+  click.echo('Plan:')
+  if cluster_ids:
+    click.echo('\tfor each of the %d clusters %s' % (len(cluster_ids), ', '.join(cluster_ids)))
+
+  click.echo('')
+  click.echo('Hosts:')
+  for group, count in host_counts:
+    click.echo('\t%s: %d' % (group, count))
+
+  click.echo('')
+  stack_name, parameters = plan_cloudformation_parameters(extra_vars)
+  click.echo('CloudFormation stack %s:' % stack_name)
+  for name, value in parameters:
+    click.echo('\t%s: %s' % (name, value))
+
+  history = load_stage_history()
+  total = 0
+  missing = False
+
+  click.echo('')
+  click.echo('Stages:')
+  for stage, result in stage_results:
+    click.echo('\t%s: skipped, finished in a previous run' % stage)
+  for number, run in enumerate(runs):
+    click.echo('\tansible-playbook run %d:' % (number + 1))
+    for playbook in run:
+      stage = stage_name(playbook)
+      if stage in history:
+        estimate = sum(history[stage]) / len(history[stage])
+        total += estimate
+        click.echo('\t\t%s: about %s (%d timed runs)' % (stage, format_seconds(estimate), len(history[stage])))
+      else:
+        missing = True
+        click.echo('\t\t%s: no timed runs to estimate from' % stage)
+
+  click.echo('')
+  if history:
+    click.echo('Estimated duration: %s%s' % (format_seconds(total), ' at least' if missing else ''))
+  else:
+    click.echo('Run with --timing to record stage durations for later estimates.')
+
+def stage_name(playbook):
+  return os.path.splitext(os.path.basename(playbook))[0]
+
+def write_pipeline_playbook(cluster_id, playbooks, status_file):
+  ''' Writes a playbook running the given playbooks in turn, each one followed
+  by playbooks/pipeline_stage.yml to record it in status_file, and returns
+  its path. It lives next to the playbooks so that their includes resolve. '''
+
+  path = 'playbooks/.pipeline-%s.yml' % cluster_id
+  lines = ['# Generated by run.py --pipeline for cluster %s, do not edit' % cluster_id, '---']
+  for playbook in playbooks:
+    lines.append('- include: %s' % os.path.relpath(playbook, 'playbooks'))
+    lines.append('- include: pipeline_stage.yml pipeline_stage=%s pipeline_status_file=%s'
+                 % (stage_name(playbook), os.path.abspath(status_file)))
+
+  with open(path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return path
+
+def read_pipeline_status(status_file):
+  ''' Returns the stages recorded as finished by playbooks/pipeline_stage.yml,
+  as (stage, time finished) in order '''
+
+  if not os.path.exists(status_file):
+    return []
+  finished = []
+  with open(status_file) as f:
+    for line in f.read().splitlines():
+      fields = line.split()
+      if len(fields) == 3 and fields[0] == 'done':
+        finished.append((fields[1], float(fields[2])))
+  return finished
+
+def format_seconds(seconds):
+  minutes, seconds = divmod(int(round(seconds)), 60)
+  if minutes:
+    return '%dm %02ds' % (minutes, seconds)
+  return '%ds' % seconds
+
+def checkpoint_path(cluster_id):
+  return '.ansible/checkpoints/%s.json' % cluster_id
+
+def load_checkpoint(cluster_id):
+  ''' Returns the stages recorded in the checkpoint of a cluster, by stage
+  name '''
+
+  try:
+    with open(checkpoint_path(cluster_id)) as f:
+      return json.load(f)['stages']
+  except (IOError, ValueError, KeyError):
+    return {}
+
+def save_checkpoint(cluster_id, stages):
+  path = checkpoint_path(cluster_id)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path + '.tmp', 'w') as f:
+    json.dump({'cluster_id': cluster_id, 'stages': stages}, f, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+
+def stage_params(playbook, extra_vars):
+  ''' Fingerprint of what a stage runs with: its playbook and every variable
+  passed to ansible-playbook. Only the hash is kept, as the variables include
+  passwords. '''
+
+  import hashlib
+
+  params = hashlib.sha1()
+  params.update(json.dumps(extra_vars, sort_keys=True))
+  if os.path.exists(playbook):
+    with open(playbook) as f:
+      params.update(f.read())
+  return params.hexdigest()
 
-hexboard_sizes = ['tiny', 'xsmall', 'small', 'medium', 'large', 'xlarge']
 
 @click.command()
 
@@ -17,7 +708,7 @@ hexboard_sizes = ['tiny', 'xsmall', 'small', 'medium', 'large', 'xlarge']
 @click.option('--num-infra', type=click.IntRange(1,3), default=1,
               show_default=True, help='Number of infrastructure nodes')
 @click.option('--hexboard-size', type=click.Choice(hexboard_sizes),
-              help='Override Hexboard size calculation (tiny=32, xsmall=64, small=108, medium=266, large=512, xlarge=1026)',
+              help='Override Hexboard size calculation, by default the largest that fits on the application nodes (tiny=32, xsmall=64, small=108, medium=266, large=512, xlarge=1026)',
               show_default=True)
 @click.option('--console-port', default='443', type=click.IntRange(1,65535), help='OpenShift web console port',
               show_default=True)
@@ -29,7 +720,7 @@ hexboard_sizes = ['tiny', 'xsmall', 'small', 'medium', 'large', 'xlarge']
               help='password for all users', show_default=True)
 
 ### Smoke test options
-@click.option('--run-smoke-tests', is_flag=True, help='Run workshop smoke tests')
+@click.option('--run-smoke-tests/--no-run-smoke-tests', default=False, help='Run workshop smoke tests')
 @click.option('--num-smoke-test-users', default=5, type=click.INT,
               help='Number of smoke test users', show_default=True)
 @click.option('--run-only-smoke-tests', is_flag=True, help='Run only the workshop smoke tests')
@@ -59,13 +750,13 @@ hexboard_sizes = ['tiny', 'xsmall', 'small', 'medium', 'large', 'xlarge']
 @click.option('--rhsm-user', help='Red Hat Subscription Management User')
 @click.option('--rhsm-pass', help='Red Hat Subscription Management Password',
                 hide_input=True,)
-@click.option('--skip-subscription-management', is_flag=True,
+@click.option('--skip-subscription-management/--no-skip-subscription-management', default=False,
               help='Skip subscription management steps')
-@click.option('--use-certificate-repos', is_flag=True,
+@click.option('--use-certificate-repos/--no-use-certificate-repos', default=False,
               help='Uses certificate-based yum repositories for the AOS content. Requires providing paths to local certificate key and pem files.')
 @click.option('--aos-repo', help='An alternate URL to locate software')
-@click.option('--prerelease', help='If using prerelease software, set to true',
-              show_default=True, default=False, is_flag=True)
+@click.option('--prerelease/--no-prerelease', help='If using prerelease software, set to true',
+              show_default=True, default=False)
 @click.option('--kerberos-user', help='Kerberos userid (eg: jsmith) for use with --prerelease')
 @click.option('--kerberos-token', help='Token to go with the kerberos user for use with --prerelease')
 @click.option('--registry-url', help='A URL for an alternate Docker registry for dockerized components of OpenShift',
@@ -78,6 +769,28 @@ hexboard_sizes = ['tiny', 'xsmall', 'small', 'medium', 'large', 'xlarge']
               help='Specify a path to a specific playbook to debug with all vars')
 @click.option('--cleanup', is_flag=True,
               help='Deletes environment')
+@click.option('--pipeline', is_flag=True,
+              help='Run the playbooks after the bootstrap as stages of a single ansible-playbook run, so their shared setup runs once')
+@click.option('--resume', is_flag=True,
+              help='Skip the stages that finished in a previous run of this cluster with the same options')
+@click.option('--bake-ami', is_flag=True,
+              help='Build an AMI from --ami with the OpenShift packages for --package-version and the demo images, for --baked-ami')
+@click.option('--baked-ami/--no-baked-ami', default=False,
+              help='Launch the cluster from the AMI last built by --bake-ami for --package-version in --region, loading the demo images from disk instead of pulling them')
+@click.option('--profile',
+              help='Options from profiles/PROFILE.yml, .yaml or .ini, or from a file; the command line overrides them')
+@click.option('--plan', is_flag=True,
+              help='Show the stages, CloudFormation parameters, hosts and estimated durations of the run without running it')
+@click.option('--timing', is_flag=True,
+              help='Record how long every task takes on every host, under .ansible/timing/CLUSTER_ID')
+
+### Batch options
+@click.option('--clusters',
+              help='Provision these clusters (comma separated cluster identifiers) at the same time, instead of --cluster-id')
+@click.option('--cluster-count', type=click.IntRange(1, None),
+              help='Provision this many clusters at the same time, named CLUSTER_ID-1 to CLUSTER_ID-N')
+@click.option('--batch-workers', default=4, type=click.IntRange(1, None), show_default=True,
+              help='Number of clusters provisioned at a time with --clusters or --cluster-count')
 @click.help_option('--help', '-h')
 @click.option('-v', '--verbose', count=True)
 
@@ -113,64 +826,70 @@ def launch_demo_env(num_nodes,
                     default_password=None,
                     debug_playbook=None,
                     cleanup=False,
+                    pipeline=False,
+                    resume=False,
+                    bake_ami=False,
+                    baked_ami=False,
+                    timing=False,
+                    plan=False,
+                    profile=None,
+                    clusters=None,
+                    cluster_count=None,
+                    batch_workers=4,
                     verbose=0):
 
   # Force num_masters = 3 because of an issue with API startup and ELB health checks and more
   num_masters = 3
 
-  # If not running cleanup need to prompt for the R53 zone:
-  if r53_zone is None:
-    r53_zone = click.prompt('R53 zone')
-
-  # Cannot run cleanup with no-confirm
-  if cleanup and no_confirm:
-    click.echo('Cannot use --cleanup and --no-confirm as it is not safe.')
+  errors = validate_params(locals())
+  if errors:
+    for error in errors:
+      click.echo(error)
     sys.exit(1)
 
-  # If skipping subscription management, must have cert repos enabled
-  # If cleaning up, this is ok
-  if not cleanup:
-    if skip_subscription_management and not use_certificate_repos:
-      click.echo('Cannot skip subscription management without using certificate repos.')
-      sys.exit(1)
+  # A batch provisions several clusters with the same options
+  cluster_ids = []
+  if clusters:
+    cluster_ids = [c.strip() for c in clusters.split(',') if c.strip()]
+  elif cluster_count:
+    cluster_ids = ['%s-%d' % (cluster_id, i) for i in range(1, cluster_count + 1)]
 
-  # If using subscription management, cannot use certificate repos
-  if not skip_subscription_management and use_certificate_repos:
-    click.echo('Must skip subscription management when using certificate repos')
-    sys.exit(1)
+  # Only prompt once the options are known to be valid; baking an AMI does
+  # not need the R53 zone. A plan asks nothing and shows placeholders.
+  if r53_zone is None and not bake_ami:
+    if plan:
+      r53_zone = '<r53-zone>'
+    else:
+      r53_zone = click.prompt('R53 zone')
 
   # Prompt for RHSM user and password if not skipping subscription management
   if not skip_subscription_management:
     # If the user already provided values, don't bother asking again
     if rhsm_user is None:
-      rhsm_user = click.prompt("RHSM username?")
-    if rhsm_pass is None:
+      if plan:
+        rhsm_user = '<rhsm-user>'
+      else:
+        rhsm_user = click.prompt("RHSM username?")
+    if rhsm_pass is None and not plan:
       rhsm_pass = click.prompt("RHSM password?", hide_input=True, confirmation_prompt=True)
 
-  # User must supply a repo URL if using certificate repos
-  if use_certificate_repos and aos_repo is None:
-    click.echo('Must provide a repo URL via --aos-repo when using certificate repos')
-    sys.exit(1)
+  # what later runs for this cluster start from, prompts answered
+  resolved = dict(locals())
 
-  # User must supply kerberos user and token with --prerelease
-  if prerelease and ( kerberos_user is None or kerberos_token is None ):
-    click.echo('Must provider --kerberos-user / --kerberos-token with --prerelease')
-    sys.exit(1)
+  # Launch from the AMI baked for this package version
+  if baked_ami:
+    baked = load_baked_amis().get(region, {}).get(package_version)
+    if baked is None:
+      click.echo('No AMI was baked for package version %s in %s, run with --bake-ami first' % (package_version, region))
+      sys.exit(1)
+    ami = baked['ami']
 
-  # Override hexboard size calculation
+  # Size the hexboard to the pods the application nodes can run, unless
+  # overridden
+  capacity, node_pods, node_bound, system_pods = hexboard_capacity(num_nodes, num_infra, node_instance_type)
   if hexboard_size is None:
-    if num_nodes <= 1:
-      hexboard_size = 'tiny'
-    elif num_nodes < 3:
-      hexboard_size = 'xsmall'
-    elif num_nodes < 5:
-      hexboard_size = 'small'
-    elif num_nodes < 9:
-      hexboard_size = 'medium'
-    elif num_nodes < 15:
-      hexboard_size = 'large'
-    else:
-      hexboard_size = 'xlarge'
+    hexboard_size = fit_hexboard(capacity)
+  headroom = capacity - dict(hexboard_pods)[hexboard_size]
 
   # Calculate various DNS values
   host_zone="%s.%s" % (cluster_id, r53_zone)
@@ -178,8 +897,18 @@ def launch_demo_env(num_nodes,
 
   # Display information to the user about their choices
   click.echo('Configured values:')
-  click.echo('\tcluster_id: %s' % cluster_id)
-  click.echo('\tami: %s' % ami)
+  if cluster_ids:
+    click.echo('\tclusters: %s (%d at a time)' % (', '.join(cluster_ids), batch_workers))
+  else:
+    click.echo('\tcluster_id: %s' % cluster_id)
+  if profile:
+    click.echo('\tprofile: %s' % profile)
+  if not cluster_ids and os.path.exists(params_path(cluster_id)):
+    click.echo('\tdefaults from earlier runs: %s' % params_path(cluster_id))
+  if baked_ami:
+    click.echo('\tami: %s (baked for %s)' % (ami, package_version))
+  else:
+    click.echo('\tami: %s' % ami)
   click.echo('\tregion: %s' % region)
   click.echo('\tmaster instance_type: %s' % master_instance_type)
   click.echo('\tnode_instance_type: %s' % node_instance_type)
@@ -203,7 +932,17 @@ def launch_demo_env(num_nodes,
     click.echo('\tkerberos token: %s' % kerberos_token)
 
   click.echo('\tregistry_url: %s' % registry_url)
-  click.echo('\thexboard_size: %s' % hexboard_size)
+  click.echo('\thexboard_size: %s (%d pods)' % (hexboard_size, dict(hexboard_pods)[hexboard_size]))
+  if node_instance_type not in instance_types:
+    click.echo('\thexboard capacity: %d pods, %d per node (%s is not in the instance type table, only max-pods is known)' % (
+      capacity, node_pods, node_instance_type))
+  else:
+    click.echo('\thexboard capacity: %d pods, %d per node (bound by %s)' % (capacity, node_pods, node_bound))
+  click.echo('\tsystem pods on the application nodes: %d' % system_pods)
+  click.echo('\thexboard headroom: %d pods' % headroom)
+  if headroom < 0:
+    click.echo('\tWarning: the %s hexboard needs %d pods more than the application nodes can run' % (
+      hexboard_size, -headroom))
   click.echo('\tr53_zone: %s' % r53_zone)
   click.echo('\tapp_dns_prefix: %s' % app_dns_prefix)
   click.echo('\thost dns: %s' % host_zone)
@@ -227,11 +966,11 @@ def launch_demo_env(num_nodes,
   if debug_playbook:
     click.echo('We will debug the following playbook: %s' % (debug_playbook))
 
-  if not no_confirm and not cleanup:
+  if not no_confirm and not cleanup and not plan:
     click.confirm('Continue using these values?', abort=True)
 
   # Special confirmations for cleanup
-  if cleanup:
+  if cleanup and not plan:
     click.confirm('Delete the cluster %s' % cluster_id, abort=True)
     click.confirm('ARE YOU REALLY SURE YOU WANT TO DELETE THE CLUSTER %s' % cluster_id, abort=True)
     click.confirm('Press enter to continue', abort=True, default=True)
@@ -244,6 +983,8 @@ def launch_demo_env(num_nodes,
     playbooks = ['playbooks/projects_setup.yml']
   elif cleanup:
     playbooks = ['playbooks/cleanup.yml']
+  elif bake_ami:
+    playbooks = ['playbooks/bake_ami.yml']
   else:
 
     # start with the basic setup
@@ -261,98 +1002,232 @@ def launch_demo_env(num_nodes,
     playbooks.append('playbooks/openshift_setup.yml')
     playbooks.append('playbooks/projects_setup.yml')
 
-  for playbook in playbooks:
+  # a bake runs under a cluster id without making the cluster, so it keeps
+  # nothing for it
+  if not cluster_ids and not plan and not cleanup and not bake_ami:
+    save_params(cluster_id, resolved)
 
-    # hide cache output unless in verbose mode
-    devnull='> /dev/null'
+  if cluster_ids and not plan:
+    failed = run_batch(cluster_ids, locals(), batch_workers, [stage_name(playbook) for playbook in playbooks])
+    sys.exit(1 if failed else 0)
 
-    if verbose > 0:
-      devnull=''
-
-    # refresh the inventory cache to prevent stale hosts from
-    # interferring with re-running
-    command='inventory/aws/hosts/ec2.py --refresh-cache %s' % (devnull)
-    os.system(command)
-
-    # remove any cached facts to prevent stale data during a re-run
-    command='rm -rf .ansible/cached_facts'
-    os.system(command)
-
-    command='ansible-playbook -i inventory/aws/hosts -e \'cluster_id=%s \
-    ec2_region=%s \
-    ec2_image=%s \
-    ec2_keypair=%s \
-    ec2_master_instance_type=%s \
-    ec2_infra_instance_type=%s \
-    ec2_node_instance_type=%s \
-    r53_zone=%s \
-    r53_host_zone=%s \
-    r53_wildcard_zone=%s \
-    console_port=%s \
-    api_port=%s \
-    num_app_nodes=%s \
-    num_infra_nodes=%s \
-    num_masters=%s \
-    hexboard_size=%s \
-    deployment_type=%s \
-    package_version=-%s \
-    rhsm_user=%s \
-    rhsm_pass=%s \
-    skip_subscription_management=%s \
-    use_certificate_repos=%s \
-    aos_repo=%s \
-    prerelease=%s \
-    kerberos_user=%s \
-    kerberos_token=%s \
-    registry_url=%s \
-    run_smoke_tests=%s \
-    run_only_smoke_tests=%s \
-    num_smoke_test_users=%s \
-    default_password=%s\' %s' % (cluster_id,
-                    region,
-                    ami,
-                    keypair,
-                    master_instance_type,
-                    infra_instance_type,
-                    node_instance_type,
-                    r53_zone,
-                    host_zone,
-                    wildcard_zone,
-                    console_port,
-                    api_port,
-                    num_nodes,
-                    num_infra,
-                    num_masters,
-                    hexboard_size,
-                    deployment_type,
-                    package_version,
-                    rhsm_user,
-                    rhsm_pass,
-                    skip_subscription_management,
-                    use_certificate_repos,
-                    aos_repo,
-                    prerelease,
-                    kerberos_user,
-                    kerberos_token,
-                    registry_url,
-                    run_smoke_tests,
-                    run_only_smoke_tests,
-                    num_smoke_test_users,
-                    default_password,
-                    playbook)
+  # only look at this cluster's instances in its own region when building
+  # the inventory; ec2.py and every ansible-playbook below inherit these
+  os.environ['EC2_INVENTORY_REGION'] = region
+  os.environ['EC2_INVENTORY_CLUSTER_ID'] = cluster_id
+  if r53_zone:
+    os.environ['EC2_INVENTORY_ROUTE53_ZONE'] = r53_zone
 
-    if verbose > 0:
-      command += " -" + "".join(['v']*verbose)
-      click.echo('We are running: %s' % command)
+  # keep facts and SSH control sockets apart from the other clusters
+  # provisioned at the same time; % is doubled as Ansible expands it
+  facts_dir = '.ansible/cached_facts/%s' % cluster_id
+  os.environ['ANSIBLE_CACHE_PLUGIN_CONNECTION'] = facts_dir
+  os.environ['ANSIBLE_SSH_CONTROL_PATH'] = '/var/tmp/%s-%%%%h-%%%%r' % cluster_id
+
+  # the -e values given to every ansible-playbook run
+  extra_vars = {
+    'cluster_id': cluster_id,
+    'ec2_region': region,
+    'ec2_image': ami,
+    'ec2_keypair': keypair,
+    'ec2_master_instance_type': master_instance_type,
+    'ec2_infra_instance_type': infra_instance_type,
+    'ec2_node_instance_type': node_instance_type,
+    'r53_zone': r53_zone,
+    'r53_host_zone': host_zone,
+    'r53_wildcard_zone': wildcard_zone,
+    'console_port': console_port,
+    'api_port': api_port,
+    'num_app_nodes': num_nodes,
+    'num_infra_nodes': num_infra,
+    'num_masters': num_masters,
+    'hexboard_size': hexboard_size,
+    'deployment_type': deployment_type,
+    'package_version': '-%s' % package_version,
+    'rhsm_user': rhsm_user,
+    'rhsm_pass': rhsm_pass,
+    'skip_subscription_management': skip_subscription_management,
+    'use_certificate_repos': use_certificate_repos,
+    'aos_repo': aos_repo,
+    'prerelease': prerelease,
+    'kerberos_user': kerberos_user,
+    'kerberos_token': kerberos_token,
+    'registry_url': registry_url,
+    'run_smoke_tests': run_smoke_tests,
+    'run_only_smoke_tests': run_only_smoke_tests,
+    'num_smoke_test_users': num_smoke_test_users,
+    'default_password': default_password,
+    'baked_skips': []
+  }
 
-    status = os.system(command)
-    if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0:
-      return os.WEXITSTATUS(status)
+  bake_result_file = os.path.abspath('.ansible/bake-%s.json' % region)
+  if bake_ami:
+    extra_vars['bake_result_file'] = bake_result_file
+
+  # only provisioning runs are checkpointed; every stage finished with the
+  # same options is recorded, and --resume skips the leading ones as later
+  # stages build on the state left by earlier ones
+  checkpointed = not debug_playbook and not run_only_smoke_tests and not cleanup and not bake_ami
+  checkpoint = {}
+  if checkpointed:
+    checkpoint = load_checkpoint(cluster_id)
+
+  params = dict((playbook, stage_params(playbook, extra_vars)) for playbook in playbooks)
+  stage_results = []
+
+  remaining = list(playbooks)
+  if resume and checkpointed:
+    while remaining and stage_name(remaining[0]) in checkpoint and \
+          checkpoint[stage_name(remaining[0])]['params'] == params[remaining[0]]:
+      stage_results.append((stage_name(remaining[0]), 'skipped'))
+      remaining.pop(0)
+
+  # the bootstrap playbook creates the instances the others run on and
+  # Ansible 1.9 cannot reload its inventory within a run, so it always
+  # runs on its own; with --pipeline the others run as stages of one more
+  # run that gathers facts and sets up groups once
+  runs = [[playbook] for playbook in remaining]
+  if pipeline and remaining:
+    if remaining[0] == 'playbooks/cloudformation_setup.yml':
+      runs = [remaining[:1], remaining[1:]]
+    else:
+      runs = [remaining]
+    runs = [run for run in runs if run]
+
+  if plan:
+    host_counts = [('masters', num_masters),
+                   ('infrastructure nodes', num_infra),
+                   ('application nodes', num_nodes),
+                   ('nodes (all hosts)', num_masters + num_infra + num_nodes)]
+    print_plan(runs, stage_results, extra_vars, host_counts, cluster_ids)
+    return
+
+  # the stages about to run no longer count as finished, until they do again
+  if checkpointed:
+    for playbook in remaining:
+      checkpoint.pop(stage_name(playbook), None)
+    save_checkpoint(cluster_id, checkpoint)
+
+  status_file = '.ansible/pipeline-%s.status' % cluster_id
+  exit_code = 0
+
+  # the variables go through a file: nothing in them has to survive
+  # quoting, and they stay out of the process list
+  extra_vars_file = write_extra_vars(cluster_id, extra_vars)
+
+  # every command run is logged with its output
+  log_path = '.ansible/logs/%s/%s.log' % (cluster_id, time.strftime('%Y%m%d-%H%M%S'))
+  if not os.path.isdir(os.path.dirname(log_path)):
+    os.makedirs(os.path.dirname(log_path))
+  log = open(log_path, 'a')
+
+  # with --timing, playbooks/callback_plugins/timing.py writes the timeline
+  # of every ansible-playbook run next to the stage times
+  timing_dir = '.ansible/timing/%s/%s' % (cluster_id, time.strftime('%Y%m%d-%H%M%S'))
+  if timing and not os.path.isdir(timing_dir):
+    os.makedirs(timing_dir)
+  stage_seconds = {}
+
+  # with --baked-ami, once the instances exist, the steps their AMI makes
+  # unnecessary are skipped
+  baked_ami_ids = [ami] if baked_ami else []
+
+  for run in runs:
+    # the stage then runs on the inventory refreshed for its skips
+    refresh = True
+    if baked_ami_ids and 'playbooks/cloudformation_setup.yml' not in run:
+      refresh_inventory(log, verbose)
+      refresh = False
+      extra_vars['baked_skips'] = baked_stage_skips(read_inventory(log), cluster_id, baked_ami_ids)
+      write_extra_vars(cluster_id, extra_vars)
+
+    if timing:
+      if len(run) == 1:
+        os.environ['DEMO_TIMING_FILE'] = '%s/%s.json' % (timing_dir, stage_name(run[0]))
+      else:
+        os.environ['DEMO_TIMING_FILE'] = '%s/pipeline.json' % timing_dir
+
+    start = time.time()
+    if len(run) == 1:
+      result = run_playbook(run[0], extra_vars_file, facts_dir, log, verbose, refresh)
+      finished = []
+      if result.ok:
+        finished = [(stage_name(run[0]), result.end)]
+    else:
+      if os.path.exists(status_file):
+        os.remove(status_file)
+      result = run_playbook(write_pipeline_playbook(cluster_id, run, status_file), extra_vars_file, facts_dir, log, verbose,
+                            refresh)
+      finished = read_pipeline_status(status_file)
+    end = result.end
+    exit_code = result.exit_code
+
+    # each stage took from the end of the previous one to its own; the
+    # first one also includes the setup of the run
+    for stage, stage_end in finished:
+      stage_seconds[stage] = stage_end - start
+      start = stage_end
+    finished = dict(finished)
+
+    # stages run in order, so the first one that did not finish is the
+    # one that failed
+    for playbook in run:
+      stage = stage_name(playbook)
+      if stage in finished:
+        stage_results.append((stage, 0))
+      else:
+        stage_seconds[stage] = end - start
+        stage_results.append((stage, exit_code or 1))
+        break
+
+    if checkpointed:
+      for playbook in run:
+        if stage_name(playbook) in finished:
+          checkpoint[stage_name(playbook)] = {'params': params[playbook], 'finished': finished[stage_name(playbook)]}
+      save_checkpoint(cluster_id, checkpoint)
+
+    if exit_code != 0:
+      break
+
+  log.close()
+
+  if timing:
+    with open('%s/stages.json' % timing_dir, 'w') as f:
+      json.dump({'cluster_id': cluster_id,
+                 'pipeline': pipeline,
+                 'stages': [{'stage': stage, 'result': result, 'seconds': stage_seconds.get(stage)}
+                            for stage, result in stage_results]}, f, indent=2)
+
+  if len(playbooks) > 1:
+    results = dict(stage_results)
+    click.echo('Stages:')
+    for playbook in playbooks:
+      stage = stage_name(playbook)
+      if stage not in results:
+        click.echo('\t%s: not run' % stage)
+      elif results[stage] == 'skipped':
+        click.echo('\t%s: skipped, finished in a previous run' % stage)
+      elif results[stage] == 0:
+        click.echo('\t%s: ok (%s)' % (stage, format_seconds(stage_seconds[stage])))
+      else:
+        click.echo('\t%s: failed (exit code %s) after %s' % (stage, results[stage], format_seconds(stage_seconds[stage])))
+    if timing:
+      click.echo('Task timings were written to %s' % timing_dir)
+
+  if exit_code != 0:
+    click.echo('The output of every command is in %s' % log_path)
+    sys.exit(exit_code)
 
   # if the last run playbook didn't explode, assume cluster provisioned successfully
   # but make sure that user was not just running tests or cleaning up
-  if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
-    if not debug_playbook and not run_only_smoke_tests and not cleanup:
+  if exit_code == 0:
+    if bake_ami:
+      with open(bake_result_file) as f:
+        baked = json.load(f)
+      record_baked_ami(region, package_version, baked['ami'], ami)
+      click.echo('The AMI for package version %s in %s is %s; launch clusters from it with --baked-ami' % (package_version, region, baked['ami']))
+
+    elif not debug_playbook and not run_only_smoke_tests and not cleanup:
       click.echo('Your cluster provisioned successfully. The console is available at https://openshift.%s:%s' % (host_zone, console_port))
       click.echo('You can SSH into a master using the same SSH key with: ssh -i /path/to/key.pem openshift@openshift-master.%s' % (host_zone))
       click.echo('**After logging into the OpenShift console** you will need to visit https://metrics.%s and accept the Hawkular SSL certificate' % ( wildcard_zone ))
@@ -360,11 +1235,14 @@ def launch_demo_env(num_nodes,
 
     if cleanup:
       click.echo('Your cluster, %s, was de-provisioned and removed successfully.' % (cluster_id))
+      for path in [checkpoint_path(cluster_id), params_path(cluster_id)]:
+        if os.path.exists(path):
+          os.remove(path)
 
 if __name__ == '__main__':
-  # check for AWS access info
-  if os.getenv('AWS_ACCESS_KEY_ID') is None or os.getenv('AWS_SECRET_ACCESS_KEY') is None:
-    print 'AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY **MUST** be exported as environment variables.'
-    sys.exit(1)
-
-  launch_demo_env(auto_envvar_prefix='OSE_DEMO')
+  try:
+    default_map = resolve_defaults(sys.argv[1:])
+  except click.UsageError, e:
+    e.show()
+    sys.exit(e.exit_code)
+  launch_demo_env(auto_envvar_prefix='OSE_DEMO', default_map=default_map)
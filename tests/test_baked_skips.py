@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim: sw=2 ts=2
+
+'''
+Checks which steps run.py --baked-ami skips, against inventories in the
+format of ec2.py --list. Runs offline:
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import run
+
+BAKED = 'ami-baked'
+
+
+def inventory(images, cluster_id='demo.1', groups_as_dicts=False):
+  ''' Returns an ec2.py --list output with a host per image in images, all
+  tagged with the cluster, and a host of another cluster from another
+  image '''
+
+  hosts = ['10.0.0.%d' % i for i in range(len(images))]
+  hostvars = dict((host, {'ec2_image_id': image}) for host, image in zip(hosts, images))
+  hostvars['10.0.1.0'] = {'ec2_image_id': 'ami-other'}
+  group = {'hosts': hosts} if groups_as_dicts else hosts
+  return {'tag_openshift-demo_' + cluster_id.replace('.', '_'): group,
+          'tag_openshift-demo_other': ['10.0.1.0'],
+          '_meta': {'hostvars': hostvars}}
+
+
+class BakedStageSkipsTest(unittest.TestCase):
+
+  def test_all_hosts_from_the_baked_ami(self):
+    self.assertEqual(run.baked_stage_skips(inventory([BAKED] * 3), 'demo.1', [BAKED]),
+                     run.BAKED_STEPS)
+
+  def test_groups_with_hosts_and_children(self):
+    self.assertEqual(run.baked_stage_skips(inventory([BAKED] * 3, groups_as_dicts=True), 'demo.1', [BAKED]),
+                     run.BAKED_STEPS)
+
+  def test_one_host_from_another_image(self):
+    self.assertEqual(run.baked_stage_skips(inventory([BAKED, 'ami-source', BAKED]), 'demo.1', [BAKED]), [])
+
+  def test_host_without_hostvars(self):
+    fake = inventory([BAKED, BAKED])
+    del fake['_meta']['hostvars']['10.0.0.1']
+    self.assertEqual(run.baked_stage_skips(fake, 'demo.1', [BAKED]), [])
+
+  def test_no_hosts_yet(self):
+    self.assertEqual(run.baked_stage_skips(inventory([]), 'demo.1', [BAKED]), [])
+    self.assertEqual(run.baked_stage_skips({}, 'demo.1', [BAKED]), [])
+
+  def test_no_baked_ami(self):
+    self.assertEqual(run.baked_stage_skips(inventory([BAKED] * 3), 'demo.1', []), [])
+
+  def test_skips_are_a_copy(self):
+    skips = run.baked_stage_skips(inventory([BAKED]), 'demo.1', [BAKED])
+    skips.append('something')
+    self.assertNotEqual(run.BAKED_STEPS, skips)
+
+
+if __name__ == '__main__':
+  unittest.main()